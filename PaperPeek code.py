@@ -6,6 +6,7 @@ import json
 import chardet
 import numpy as np
 import pandas as pd
+import torch
 import re
 import math
 import string
@@ -94,33 +95,32 @@ def process_file(file_path, file_type):
 
 
 
-# Initialize a dictionary to store data
-data = {}
+# Function to process all files of one paper folder
+def load_paper_folder(folder_path):
+    paper = {'citation': None, 'summary': None, 'document': None}
 
-# Step 2: Traverse the directories and process files
-for root, dirs, files in os.walk(dataset_path):
-    parts = root.split(os.sep)
-    if len(parts) > parts.index('IRdataset') + 1:   #change the dataset name if applies
-        folder_name = parts[parts.index('IRdataset') + 1]
-    else:
-        continue  # Skip the root directory
+    for root, dirs, files in os.walk(folder_path):
+        for file in files:
+            file_path = os.path.join(root, file)
 
-    if folder_name not in data:
-        data[folder_name] = {'citation': None, 'summary': None, 'document': None}
+            # Determine the type of file and process accordingly
+            if file.endswith('.json'):
+                paper['citation'] = process_file(file_path, 'json')
+            elif file.endswith('.txt') and 'summary' in root:
+                paper['summary'] = process_file(file_path, 'txt')
+            elif file.endswith('.xml') and 'Documents_xml' in root:
+                paper['document'] = process_file(file_path, 'xml')
 
-    for file in files:
-        file_path = os.path.join(root, file)
+    return paper
+
+# Initialize a dictionary to store data
+data = {}
 
-        # Determine the type of file and process accordingly
-        if file.endswith('.json'):
-            file_content = process_file(file_path, 'json')
-            data[folder_name]['citation'] = file_content
-        elif file.endswith('.txt') and 'summary' in root:
-            file_content = process_file(file_path, 'txt')
-            data[folder_name]['summary'] = file_content
-        elif file.endswith('.xml') and 'Documents_xml' in root:
-            file_content = process_file(file_path, 'xml')
-            data[folder_name]['document'] = file_content
+# Step 2: Traverse the paper folders and process files
+for folder_name in sorted(os.listdir(dataset_path)):
+    folder_path = os.path.join(dataset_path, folder_name)
+    if os.path.isdir(folder_path):
+        data[folder_name] = load_paper_folder(folder_path)
 
 # Convert the dictionary to a DataFrame
 df = pd.DataFrame.from_dict(data, orient='index').reset_index().rename(columns={'index': 'folder_name'})
@@ -218,10 +218,343 @@ def preprocess_text(text):
 df['processed_summary'] = df['summary'].apply(preprocess_text)
 df['processed_document'] = df['document'].apply(preprocess_text)
 
+"""Near-duplicate detection
+
+Preprint and camera-ready versions of a paper are found with MinHash signatures over word shingles of the
+processed document and LSH banding: only documents sharing a whole band of their signature are compared.
+Each group of near-duplicates is collapsed into one canonical document carrying the citations of all copies,
+so copies are not indexed, encoded or returned several times.
+"""
+
+import zlib
+
+MINHASH_PRIME = (1 << 31) - 1
+
+def shingle_hashes(text, shingle_size=5):
+    """
+    Hash the word shingles of a text.
+
+    :param text: The processed text.
+    :param shingle_size: Number of consecutive words in a shingle.
+    :return: Array of the distinct shingle hashes, each below MINHASH_PRIME.
+    """
+    tokens = text.split()
+    if not tokens:
+        return np.array([], dtype=np.uint64)
+
+    # A text shorter than a shingle is a single shingle
+    token_hashes = np.array([zlib.crc32(token.encode('utf-8')) for token in tokens], dtype=np.uint64)
+    shingle_size = min(shingle_size, len(tokens))
+    n_shingles = len(tokens) - shingle_size + 1
+
+    # Polynomial hash of the shingle tokens, wrapping around in 64 bits
+    hashes = np.zeros(n_shingles, dtype=np.uint64)
+    for offset in range(shingle_size):
+        hashes = hashes * np.uint64(1000003) + token_hashes[offset:offset + n_shingles]
+    return np.unique(hashes % np.uint64(MINHASH_PRIME))
+
+def minhash_signatures(texts, num_perm=128, shingle_size=5, seed=0):
+    """
+    Compute the MinHash signature of every text with num_perm universal hash functions (a * x + b) mod p.
+
+    :param texts: Iterable of processed texts.
+    :param num_perm: Length of the signatures.
+    :param shingle_size: Number of consecutive words in a shingle.
+    :param seed: Seed of the hash functions.
+    :return: Array of shape (number of texts, num_perm), empty texts get a row of MINHASH_PRIME.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, MINHASH_PRIME, size=num_perm, dtype=np.uint64)[:, None]
+    b = rng.integers(0, MINHASH_PRIME, size=num_perm, dtype=np.uint64)[:, None]
+
+    signatures = []
+    for text in texts:
+        hashes = shingle_hashes(text, shingle_size)
+        if len(hashes) == 0:
+            signatures.append(np.full(num_perm, MINHASH_PRIME, dtype=np.uint64))
+            continue
+        # a and the hashes are below 2**31, so the products fit in 64 bits
+        signatures.append(((a * hashes[None, :] + b) % np.uint64(MINHASH_PRIME)).min(axis=1))
+
+    return np.array(signatures, dtype=np.uint32).reshape(-1, num_perm)
+
+def find_near_duplicates(signatures, n_bands=16, threshold=0.8):
+    """
+    Group documents whose estimated Jaccard similarity is at least threshold.
+
+    :param signatures: MinHash signatures from minhash_signatures.
+    :param n_bands: Number of LSH bands, the signature length must be a multiple of it.
+    :param threshold: Minimum estimated Jaccard similarity of two near-duplicates.
+    :return: List of groups (sorted lists of row positions) with at least two documents.
+    """
+    n_docs, num_perm = signatures.shape
+    rows_per_band = num_perm // n_bands
+    non_empty = (signatures != MINHASH_PRIME).any(axis=1)
+
+    # Candidate pairs share all the rows of at least one band
+    candidate_pairs = set()
+    for band in range(n_bands):
+        buckets = {}
+        band_values = signatures[:, band * rows_per_band:(band + 1) * rows_per_band]
+        for position in np.flatnonzero(non_empty):
+            buckets.setdefault(band_values[position].tobytes(), []).append(position)
+        for bucket in buckets.values():
+            for i in range(len(bucket)):
+                for j in range(i + 1, len(bucket)):
+                    candidate_pairs.add((bucket[i], bucket[j]))
+
+    # Union-find over the candidate pairs that pass the threshold
+    parents = list(range(n_docs))
+
+    def find(position):
+        while parents[position] != position:
+            parents[position] = parents[parents[position]]
+            position = parents[position]
+        return position
+
+    for i, j in candidate_pairs:
+        if np.mean(signatures[i] == signatures[j]) >= threshold:
+            parents[find(j)] = find(i)
+
+    groups = {}
+    for position in range(n_docs):
+        groups.setdefault(find(position), []).append(position)
+    return [group for group in groups.values() if len(group) > 1]
+
+def merge_citations(citation_lists):
+    # Citations of the same citing paper and text are counted once. Every copy numbers its citances from 1,
+    # so the merged citances are renumbered and extract_citation_count stays the number of citations
+    merged, seen = [], set()
+    for citations in citation_lists:
+        for citation in citations or []:
+            key = (citation.get('citing_paper_id'), citation.get('raw_text'))
+            if key not in seen:
+                seen.add(key)
+                merged.append(dict(citation, citance_No=len(merged) + 1))
+    return merged
+
+def find_indexed_duplicate(signature, signatures, n_bands=16, threshold=0.8):
+    """
+    Find the indexed document a new document is a near-duplicate of, with the same LSH banding as find_near_duplicates.
+
+    :param signature: MinHash signature of the new document.
+    :param signatures: MinHash signatures of the indexed documents, one row per document.
+    :param n_bands: Number of LSH bands.
+    :param threshold: Minimum estimated Jaccard similarity of two near-duplicates.
+    :return: Row position of the most similar near-duplicate, or None.
+    """
+    if len(signatures) == 0 or (signature == MINHASH_PRIME).all():
+        return None
+    rows_per_band = len(signature) // n_bands
+    banded_length = n_bands * rows_per_band
+
+    # Candidates share all the rows of at least one band
+    bands = signatures[:, :banded_length].reshape(len(signatures), n_bands, rows_per_band)
+    candidates = np.flatnonzero((bands == signature[:banded_length].reshape(n_bands, rows_per_band)).all(axis=2).any(axis=1))
+    if len(candidates) == 0:
+        return None
+
+    similarities = (signatures[candidates] == signature).mean(axis=1)
+    best = int(np.argmax(similarities))
+    return int(candidates[best]) if similarities[best] >= threshold else None
+
+def collapse_near_duplicates(dataframe, text_col='processed_document', num_perm=128, n_bands=16, threshold=0.8, shingle_size=5):
+    """
+    Keep one canonical document per group of near-duplicates and merge the citations of the group into it.
+    The canonical document is the longest one, the score columns are recomputed from the merged citations.
+
+    :param dataframe: DataFrame with the text column, 'folder_name' and 'citation'.
+    :param text_col: Name of the text column used for the signatures.
+    :param num_perm: Length of the MinHash signatures.
+    :param n_bands: Number of LSH bands.
+    :param threshold: Minimum estimated Jaccard similarity of two near-duplicates.
+    :param shingle_size: Number of consecutive words in a shingle.
+    :return: The deduplicated DataFrame, with the folders of the collapsed copies in 'duplicate_folders'.
+    """
+    signatures = minhash_signatures(dataframe[text_col], num_perm, shingle_size)
+    groups = find_near_duplicates(signatures, n_bands, threshold)
+
+    dataframe = dataframe.reset_index(drop=True)
+    texts = dataframe[text_col].tolist()
+    folder_names = dataframe['folder_name'].tolist()
+    citations = dataframe['citation'].tolist()
+    duplicate_folders = [[] for _ in range(len(dataframe))]
+
+    dropped = []
+    for group in groups:
+        canonical = max(group, key=lambda position: len(texts[position]))
+        copies = [position for position in group if position != canonical]
+
+        citations[canonical] = merge_citations([citations[position] for position in [canonical] + copies])
+        duplicate_folders[canonical] = [folder_names[position] for position in copies]
+        dropped.extend(copies)
+        print("Near-duplicates of", folder_names[canonical], ":", duplicate_folders[canonical])
+
+    dataframe['citation'] = citations
+    dataframe['duplicate_folders'] = duplicate_folders
+    dataframe = dataframe.drop(index=dropped).reset_index(drop=True)
+
+    # Citation columns and scores of the merged documents
+    for key in keys:
+        dataframe[key] = dataframe['citation'].apply(lambda citations: [citation.get(key, None) for citation in citations])
+    dataframe['weighted_score'] = dataframe['citation'].apply(calculate_weighted_score)
+    max_weighted_score = dataframe['weighted_score'].max()
+    dataframe['normalized_score'] = dataframe['weighted_score'] / max_weighted_score if max_weighted_score else 0
+    dataframe['citation_count'] = dataframe['citance_No'].apply(extract_citation_count)
+
+    return dataframe
+
+# The index records these parameters to check papers added by sync_index against the same signatures
+DEDUP_PARAMS = {'num_perm': 128, 'n_bands': 16, 'threshold': 0.8, 'shingle_size': 5}
+
+df = collapse_near_duplicates(df, **DEDUP_PARAMS)
+
+"""Document store
+
+Each processed text is written once into a utf-8 blob with an offset array.
+DataFrames and retrieval results only carry the integer doc id, the text is memory-mapped and loaded on demand.
+"""
+
+import hashlib
+
+store_dir = 'paperpeek_store'
+
+def open_memmap_array(path, dtype, n_cols=None, mode='r'):
+    """
+    Memory-map a raw binary array file, the number of rows is derived from the file size.
+
+    :param path: Path of the binary file.
+    :param dtype: Data type of the stored values.
+    :param n_cols: Number of columns for 2D arrays. If None, the array is 1D.
+    :param mode: Memory-map mode ('r' for read-only, 'r+' for in-place updates).
+    :return: Memory-mapped array (or an empty array for an empty file).
+    """
+    row_size = np.dtype(dtype).itemsize * (n_cols or 1)
+    n_rows = os.path.getsize(path) // row_size
+    shape = (n_rows,) if n_cols is None else (n_rows, n_cols)
+    if n_rows == 0:
+        return np.zeros(shape, dtype=dtype)  # numpy cannot memory-map an empty file
+    return np.memmap(path, dtype=dtype, mode=mode, shape=shape)
+
+def append_array(path, array):
+    # Raw binary files can be extended in place, unlike .npy files
+    with open(path, 'ab') as file:
+        np.ascontiguousarray(array).tofile(file)
+
+def build_document_store(texts, store_path):
+    """
+    Write texts into a document store. The position of a text is its doc id.
+
+    :param texts: Iterable of texts.
+    :param store_path: Path prefix of the store files ('.blob', '.offsets' and '.version').
+    :return: The opened document store.
+    """
+    offsets = [0]
+    digest = hashlib.sha1()
+    with open(store_path + '.blob', 'wb') as blob:
+        for text in texts:
+            encoded = text.encode('utf-8')
+            blob.write(encoded)
+            digest.update(encoded)
+            offsets.append(offsets[-1] + len(encoded))
+
+    np.asarray(offsets, dtype=np.int64).tofile(store_path + '.offsets')
+    with open(store_path + '.version', 'w') as file:
+        file.write(digest.hexdigest())
+
+    return open_document_store(store_path)
+
+def open_document_store(store_path):
+    with open(store_path + '.version') as file:
+        version = file.read().strip()
+
+    return {
+        'path': store_path,
+        'version': version,
+        'blob': open_memmap_array(store_path + '.blob', np.uint8),
+        'offsets': open_memmap_array(store_path + '.offsets', np.int64),
+    }
+
+def get_document_text(store, doc_id):
+    start, end = store['offsets'][doc_id], store['offsets'][doc_id + 1]
+    return bytes(store['blob'][start:end]).decode('utf-8')
+
+def append_to_document_store(store_path, text):
+    """
+    Append a text to an existing document store.
+
+    :param store_path: Path prefix of the store files.
+    :param text: The text to append.
+    :return: The doc id of the appended text.
+    """
+    store = open_document_store(store_path)
+    encoded = text.encode('utf-8')
+
+    with open(store_path + '.blob', 'ab') as blob:
+        blob.write(encoded)
+    append_array(store_path + '.offsets', np.array([store['offsets'][-1] + len(encoded)], dtype=np.int64))
+
+    # Chain the version so it changes with every append
+    digest = hashlib.sha1(store['version'].encode())
+    digest.update(encoded)
+    with open(store_path + '.version', 'w') as file:
+        file.write(digest.hexdigest())
+
+    return len(store['offsets']) - 1
+
+def compact_document_store(store_path, live_doc_ids):
+    """
+    Rewrite a document store without the texts of deleted documents. Doc ids stay the same, deleted texts become empty.
+
+    :param store_path: Path prefix of the store files.
+    :param live_doc_ids: Set of the doc ids that are still in use.
+    :return: The reopened document store.
+    """
+    store = open_document_store(store_path)
+    texts = (get_document_text(store, doc_id) if doc_id in live_doc_ids else '' for doc_id in range(len(store['offsets']) - 1))
+    build_document_store(texts, store_path + '.compacting')
+
+    for extension in ['.blob', '.offsets', '.version']:
+        os.replace(store_path + '.compacting' + extension, store_path + extension)
+
+    return open_document_store(store_path)
+
+# Stores of the text columns that are no longer kept in the DataFrames
+document_stores = {}
+
+def load_column_texts(dataframe, text_col, stores=None):
+    """
+    Yield the texts of text_col row by row, reading them from the document store when the column is not in the DataFrame.
+
+    :param dataframe: DataFrame with either the text column or a 'doc_id' column.
+    :param text_col: Name of the text column.
+    :param stores: (Optional) Document stores to read from, e.g. those of an index snapshot. Defaults to document_stores.
+    """
+    stores = document_stores if stores is None else stores
+    if text_col in dataframe.columns:
+        yield from dataframe[text_col]
+    else:
+        for doc_id in dataframe['doc_id']:
+            yield get_document_text(stores[text_col], doc_id)
+
+def load_row_text(row, text_col, stores=None):
+    if text_col in row.index:
+        return row[text_col]
+    stores = document_stores if stores is None else stores
+    return get_document_text(stores[text_col], row['doc_id'])
+
+os.makedirs(store_dir, exist_ok=True)
+for text_col in ['processed_document', 'processed_summary']:
+    document_stores[text_col] = build_document_store(df[text_col], os.path.join(store_dir, text_col))
+df['doc_id'] = np.arange(len(df))
+
+# The stores hold the processed texts, the raw and processed text columns are no longer needed in memory
+df = df.drop(columns=['document', 'summary', 'processed_document', 'processed_summary'])
+
 """NEW dataframe with chosen columns"""
 
 # Selecting specific columns to create a new DataFrame
-new_df = df[['processed_document', 'processed_summary', 'normalized_score', 'citation_count','paper_name']].copy()
+new_df = df[['doc_id', 'folder_name', 'weighted_score', 'normalized_score', 'citation_count','paper_name', 'duplicate_folders']].copy()
 new_df['index'] = new_df.index
 
 # Display the first few rows of the new DataFrame to verify
@@ -247,7 +580,7 @@ def apply_tfidf_and_lda(dataframe,  document_col, n_topics_document=10):
 
     # Fit and transform the text data with TfidfVectorizer
 
-    tfidf_document = tfidf_vectorizer_document.fit_transform(dataframe[document_col])
+    tfidf_document = tfidf_vectorizer_document.fit_transform(load_column_texts(dataframe, document_col))
 
     # Initialize LDA models
     lda_document = LatentDirichletAllocation(n_components=n_topics_document, random_state=0)
@@ -315,16 +648,16 @@ def top_n_papers_refined(query, lda_model, dtm, dataframe, vectorizer, citation_
                       (citation_weight * dataframe[citation_col]) + \
                       (normalized_weight * dataframe[normalized_col])
 
-    # Add combined score to the DataFrame
-    dataframe['combined_score'] = combined_scores
+    # Add combined score to a copy of the DataFrame, so that concurrent queries do not overwrite each other's scores
+    scored_papers = dataframe.assign(combined_score=combined_scores)
 
     # Sort the DataFrame based on the combined score
-    top_papers = dataframe.sort_values(by='combined_score', ascending=False).head(n)
+    top_papers = scored_papers.sort_values(by='combined_score', ascending=False).head(n)
 
     return top_papers
 
 #document-term matrix for 'processed_document'
-dtm_document = tfidf_vectorizer_document.transform(new_df['processed_document'])
+dtm_document = tfidf_vectorizer_document.transform(load_column_texts(new_df, 'processed_document'))
 
 # the top_n_papers_refined function call
 top_papers = top_n_papers_refined(query="model",
@@ -360,8 +693,10 @@ tokenizer = AutoTokenizer.from_pretrained('allenai/scibert_scivocab_uncased')
 import pickle
 
 def save_cache_to_file(cache, filename):
-    with open(filename, 'wb') as file:
+    # Write to a temporary file first, so readers never see a half-written cache
+    with open(filename + '.tmp', 'wb') as file:
         pickle.dump(cache, file)
+    os.replace(filename + '.tmp', filename)
 
 def load_cache_from_file(filename):
     try:
@@ -370,6 +705,133 @@ def load_cache_from_file(filename):
     except FileNotFoundError:
         return {}  # Return an empty dictionary if the file doesn't exist
 
+"""Query caches (LRU with TTL eviction)"""
+
+import threading
+import time
+from collections import OrderedDict
+
+def create_lru_ttl_cache(max_size=512, ttl_seconds=None):
+    """
+    Create an in-memory cache that evicts the least recently used entry once max_size is reached
+    and treats entries older than ttl_seconds as missing. The cache can be shared by query threads.
+
+    :param max_size: Maximum number of entries kept in the cache.
+    :param ttl_seconds: Lifetime of an entry in seconds. If None, entries never expire.
+    :return: Dictionary holding the entries and the hit/miss counters.
+    """
+    return {'entries': OrderedDict(), 'max_size': max_size, 'ttl_seconds': ttl_seconds, 'hits': 0, 'misses': 0, 'lock': threading.Lock()}
+
+def cache_get(cache, key):
+    with cache['lock']:
+        entry = cache['entries'].get(key)
+        if entry is None:
+            cache['misses'] += 1
+            return None
+
+        value, stored_at = entry
+        # Drop expired entries
+        if cache['ttl_seconds'] is not None and time.monotonic() - stored_at > cache['ttl_seconds']:
+            del cache['entries'][key]
+            cache['misses'] += 1
+            return None
+
+        # Mark the entry as most recently used
+        cache['entries'].move_to_end(key)
+        cache['hits'] += 1
+        return value
+
+def cache_put(cache, key, value):
+    with cache['lock']:
+        cache['entries'][key] = (value, time.monotonic())
+        cache['entries'].move_to_end(key)
+
+        # Evict the least recently used entries
+        while len(cache['entries']) > cache['max_size']:
+            cache['entries'].popitem(last=False)
+
+def cache_clear(cache):
+    with cache['lock']:
+        cache['entries'].clear()
+
+def cache_counts(cache):
+    with cache['lock']:
+        return cache['hits'], cache['misses']
+
+# Final results of the two-level retrieval and SciBERT query embeddings are cached separately
+query_result_cache = create_lru_ttl_cache(max_size=512, ttl_seconds=3600)
+query_embedding_cache = create_lru_ttl_cache(max_size=4096, ttl_seconds=24 * 3600)
+
+from contextlib import contextmanager
+
+# Per-thread stage timings of the request being served, filled by record_stage when a load test collects them
+stage_recorder = threading.local()
+
+@contextmanager
+def record_stage(stage_name):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = getattr(stage_recorder, 'timings', None)
+        if timings is not None:
+            timings[stage_name] = timings.get(stage_name, 0.0) + time.perf_counter() - start_time
+
+def invalidate_query_caches():
+    cache_clear(query_result_cache)
+    cache_clear(query_embedding_cache)
+
+def compute_index_version(dataframe, document_col, n_topics_document=10):
+    """
+    Fingerprint the inputs of the first level index (corpus, topic count and embedding model).
+
+    :param dataframe: DataFrame containing the documents.
+    :param document_col: Name of the column holding the preprocessed documents.
+    :param n_topics_document: Number of LDA topics.
+    :return: Hex digest identifying the index version.
+    """
+    if document_col in dataframe.columns:
+        corpus_hashes = pd.util.hash_pandas_object(dataframe[document_col], index=True).values
+        digest = hashlib.sha1(corpus_hashes.tobytes())
+    else:
+        # Stored texts do not change once written, so the store version and the doc ids identify the corpus
+        digest = hashlib.sha1(document_stores[document_col]['version'].encode())
+        digest.update(dataframe['doc_id'].values.astype(np.int64).tobytes())
+    digest.update(f"{n_topics_document}|{scibert_model.config._name_or_path}".encode())
+    return digest.hexdigest()
+
+first_level_index = {'version': None}
+first_level_index_lock = threading.Lock()
+
+def get_first_level_index(dataframe, document_col='processed_document', n_topics_document=10):
+    """
+    Return the fitted LDA model, TF-IDF vectorizer and document-term matrix of the corpus.
+    The index is only rebuilt when the corpus fingerprint changes, and rebuilding it invalidates the query caches.
+
+    :param dataframe: DataFrame containing the documents.
+    :param document_col: Name of the column holding the preprocessed documents.
+    :param n_topics_document: Number of LDA topics.
+    :return: Dictionary with the index version, LDA model, vectorizer and document-term matrix.
+    """
+    global first_level_index
+    version = compute_index_version(dataframe, document_col, n_topics_document)
+    if first_level_index['version'] == version:
+        return first_level_index
+
+    # Concurrent queries wait for a single rebuild
+    with first_level_index_lock:
+        if first_level_index['version'] != version:
+            lda_model, vectorizer = apply_tfidf_and_lda(dataframe, document_col, n_topics_document)
+            first_level_index = {
+                'version': version,
+                'lda_model': lda_model,
+                'vectorizer': vectorizer,
+                'dtm': vectorizer.transform(load_column_texts(dataframe, document_col)),
+            }
+            invalidate_query_caches()
+
+        return first_level_index
+
 #embeddings_cache = load_cache_from_file('embeddings_cache.pkl')
 
 """```
@@ -389,28 +851,50 @@ save_cache_to_file(embeddings_cache, 'embeddings_cache.pkl')
 Sliding Window
 """
 
-def sliding_window(text, window_size=512, stride=256):
+def sliding_window(text, window_size=512, stride=256, return_spans=False):
     """
     Split the text into overlapping segments.
 
     :param text: The text to be split.
     :param window_size: The number of tokens in each segment.
     :param stride: The number of tokens to overlap.
-    :return: A list of text segments.
+    :param return_spans: If True, also return the (start, end) character span of each segment in the text.
+    :return: A list of text segments, and the list of their spans if return_spans is True.
     """
     # Tokenize the text
-    tokens = tokenizer.tokenize(text)
+    if return_spans:
+        encoding = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        tokens = encoding.tokens()
+        offsets = encoding['offset_mapping']
+    else:
+        tokens = tokenizer.tokenize(text)
 
     # Split tokens into overlapping segments
     segments = []
+    spans = []
     for i in range(0, len(tokens), stride):
         segment = tokens[i:i + window_size]
         segments.append(tokenizer.convert_tokens_to_string(segment))
+        if return_spans:
+            spans.append((offsets[i][0], offsets[i + len(segment) - 1][1]))
 
+    if return_spans:
+        return segments, spans
     return segments
 
 """function to get scibert embeddings"""
 
+# Number of tokens passed through SciBERT, used to compare the cost of the long document modes
+encoded_token_count = 0
+
+def encode_with_scibert(text, model, tokenizer):
+    global encoded_token_count
+    inputs = tokenizer(text, return_tensors='pt', padding=True, truncation=True, max_length=512).to(model.device)
+    encoded_token_count += inputs['input_ids'].numel()
+    with torch.no_grad():
+        output = model(**inputs)
+    return output.last_hidden_state.mean(dim=1).cpu().numpy()
+
 def get_scibert_embeddings(texts, model, tokenizer, batch_size=16):
     global embeddings_cache
     embeddings = []
@@ -419,10 +903,7 @@ def get_scibert_embeddings(texts, model, tokenizer, batch_size=16):
         if text in embeddings_cache:
             embeddings.append(embeddings_cache[text])
         else:
-            inputs = tokenizer(text, return_tensors='pt', padding=True, truncation=True, max_length=512).to(model.device)
-            with torch.no_grad():
-                output = model(**inputs)
-            embedding = output.last_hidden_state.mean(dim=1).cpu().numpy()
+            embedding = encode_with_scibert(text, model, tokenizer)
             embeddings_cache[text] = embedding
             embeddings.append(embedding)
 
@@ -430,58 +911,227 @@ def get_scibert_embeddings(texts, model, tokenizer, batch_size=16):
     embeddings = np.concatenate(embeddings, axis=0)
     return embeddings
 
+def get_query_embedding(query, model, tokenizer):
+    """
+    Return the SciBERT embedding of a query, using query_embedding_cache instead of the persisted window cache.
+
+    :param query: The preprocessed query string.
+    :param model: SciBERT model for embedding generation.
+    :param tokenizer: Tokenizer for the SciBERT model.
+    :return: 1D array with the query embedding.
+    """
+    cache_key = (model.config._name_or_path, query)
+    embedding = cache_get(query_embedding_cache, cache_key)
+    if embedding is None:
+        embedding = encode_with_scibert(query, model, tokenizer)[0]
+        cache_put(query_embedding_cache, cache_key, embedding)
+    return embedding
+
+"""Long document encoding modes
+
+'sliding' encodes the overlapping windows of sliding_window, so with stride = window_size / 2 almost every token
+goes through SciBERT twice. 'chunked' encodes non-overlapping chunks of even length (no short tail chunk), and
+'pooled' encodes the same chunks once and mean-pools the token embeddings into overlapping windows afterwards.
+"""
+
+def split_into_chunks(n_tokens, chunk_size):
+    """Split n_tokens into the fewest chunks of at most chunk_size tokens, all of about the same length."""
+    if n_tokens == 0:
+        return []
+    n_chunks = math.ceil(n_tokens / chunk_size)
+    chunk_length = math.ceil(n_tokens / n_chunks)
+    return [(start, min(start + chunk_length, n_tokens)) for start in range(0, n_tokens, chunk_length)]
+
+def encode_token_embeddings(token_ids, model, tokenizer):
+    """Encode a chunk of token ids once and return the embedding of every token (special tokens excluded)."""
+    global encoded_token_count
+    input_ids = tokenizer.build_inputs_with_special_tokens(token_ids)
+    encoded_token_count += len(input_ids)
+    with torch.no_grad():
+        output = model(input_ids=torch.tensor([input_ids], device=model.device))
+    return output.last_hidden_state[0, 1:-1].cpu().numpy()
+
+def pooled_window_embeddings(text, model, tokenizer, window_size=512, stride=256):
+    """
+    Encode every token once in non-overlapping chunks and mean-pool the token embeddings into overlapping windows.
+
+    :return: Window embeddings and their (start, end) character spans.
+    """
+    cache_key = ('pooled', window_size, stride, hashlib.sha1(text.encode('utf-8')).hexdigest())
+    if cache_key in embeddings_cache:
+        return embeddings_cache[cache_key]
+
+    encoding = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+    token_ids, offsets = encoding['input_ids'], encoding['offset_mapping']
+
+    # Chunks leave room for [CLS] and [SEP] so that no token is truncated
+    token_embeddings = np.concatenate(
+        [encode_token_embeddings(token_ids[start:end], model, tokenizer) for start, end in split_into_chunks(len(token_ids), window_size - 2)]
+        or [np.zeros((0, model.config.hidden_size), dtype=np.float32)]
+    )
+
+    # Window means from a cumulative sum, the last window ends at the last token instead of leaving a short tail
+    n_tokens = len(token_ids)
+    # An empty document has no windows, like sliding_window
+    starts = list(range(0, max(n_tokens - window_size, 0) + 1, stride)) if n_tokens else []
+    if starts and starts[-1] + window_size < n_tokens:
+        starts.append(n_tokens - window_size)
+    cumulative = np.vstack([np.zeros((1, token_embeddings.shape[1]), dtype=np.float64), np.cumsum(token_embeddings, axis=0, dtype=np.float64)])
+
+    embeddings, spans = [], []
+    for start in starts:
+        end = min(start + window_size, n_tokens)
+        embeddings.append((cumulative[end] - cumulative[start]) / (end - start))
+        spans.append((offsets[start][0], offsets[end - 1][1]))
+
+    result = (np.array(embeddings, dtype=np.float32).reshape(-1, token_embeddings.shape[1]), spans)
+    embeddings_cache[cache_key] = result
+    return result
+
+def embed_document_windows(text, model, tokenizer, window_size=512, stride=256, mode='sliding'):
+    """
+    Embed a long document as a set of windows.
+
+    :param text: The document text.
+    :param model: SciBERT model for embedding generation.
+    :param tokenizer: Tokenizer for the SciBERT model.
+    :param window_size: The number of tokens in each window.
+    :param stride: The stride between windows ('sliding' and 'pooled' modes).
+    :param mode: 'sliding', 'chunked' or 'pooled'.
+    :return: Window embeddings (2D array) and their (start, end) character spans.
+    """
+    if mode == 'pooled':
+        return pooled_window_embeddings(text, model, tokenizer, window_size, stride)
+
+    if mode == 'chunked':
+        encoding = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        tokens, offsets = encoding.tokens(), encoding['offset_mapping']
+        chunks = split_into_chunks(len(tokens), window_size - 2)
+        windows = [tokenizer.convert_tokens_to_string(tokens[start:end]) for start, end in chunks]
+        spans = [(offsets[start][0], offsets[end - 1][1]) for start, end in chunks]
+    elif mode == 'sliding':
+        windows, spans = sliding_window(text, window_size, stride, return_spans=True)
+    else:
+        raise ValueError(f"Unknown long document mode: {mode}")
+
+    if not windows:
+        return np.zeros((0, model.config.hidden_size), dtype=np.float32), spans
+    return get_scibert_embeddings(windows, model, tokenizer), spans
+
+def benchmark_long_document_modes(dataframe, queries, model, tokenizer, text_column='processed_document', modes=('sliding', 'chunked', 'pooled'), top_k=5):
+    """
+    Compare the encode cost of the long document modes and their top_k agreement with the 'sliding' windows.
+
+    :param dataframe: DataFrame with the documents to encode (e.g. the first level candidates).
+    :param queries: List of preprocessed queries.
+    :param model: SciBERT model for embedding generation.
+    :param tokenizer: Tokenizer for the SciBERT model.
+    :param text_column: Name of the text column.
+    :param modes: Modes to compare, 'sliding' is always included as the reference.
+    :param top_k: Number of documents compared per query.
+    :return: DataFrame with one row per mode.
+    """
+    global embeddings_cache, encoded_token_count
+    texts = list(load_column_texts(dataframe, text_column))
+    query_embeddings = np.array([get_query_embedding(query, model, tokenizer) for query in queries])
+    modes = ['sliding'] + [mode for mode in modes if mode != 'sliding']
+
+    saved_cache = embeddings_cache
+    report, rankings = [], {}
+    try:
+        for mode in modes:
+            # Encode with an empty cache so that every mode pays its full cost
+            embeddings_cache = {}
+            encoded_token_count = 0
+            start_time = time.perf_counter()
+            document_windows = [embed_document_windows(text, model, tokenizer, mode=mode)[0] for text in texts]
+            encode_seconds = time.perf_counter() - start_time
+
+            # Best window similarity of every document for every query
+            best_similarities = np.array([
+                cosine_similarity(query_embeddings, windows).max(axis=1) if len(windows) else np.zeros(len(queries))
+                for windows in document_windows
+            ])
+            rankings[mode] = [set(np.argsort(-best_similarities[:, query_number], kind='stable')[:top_k].tolist())
+                              for query_number in range(len(queries))]
+            # With fewer than top_k documents, every ranking holds all of them
+            ranking_size = min(top_k, len(texts))
+
+            report.append({
+                'mode': mode,
+                'windows': sum(len(windows) for windows in document_windows),
+                'encoded_tokens': encoded_token_count,
+                'encode_seconds': encode_seconds,
+                f'top{top_k}_agreement': np.mean([len(ranking & reference) / ranking_size
+                                                  for ranking, reference in zip(rankings[mode], rankings['sliding'])]),
+            })
+    finally:
+        embeddings_cache = saved_cache
+
+    report = pd.DataFrame(report)
+    print(report.to_string(index=False))
+    return report
+
 """function to retrieve the top 5 papers after implementing SciBERT model(second level retrieval)"""
 
-def process_papers_with_scibert_top_5(dataframe, text_column, query, model, tokenizer):
+def process_papers_with_scibert_top_5(dataframe, text_column, query, model, tokenizer, long_document_mode='sliding'):
 
-    query_embedding = get_scibert_embeddings([query], model, tokenizer)[0]
+    query_embedding = get_query_embedding(query, model, tokenizer)
 
     similarity_scores = []
 
     for index, row in dataframe.iterrows():
-        windows = sliding_window(row[text_column])
-        window_embeddings = get_scibert_embeddings(windows, model, tokenizer)
+        window_embeddings, spans = embed_document_windows(load_row_text(row, text_column), model, tokenizer, mode=long_document_mode)
 
         max_similarity = 0
-        most_similar_segment = ""
+        most_similar_span = (0, 0)
         for i, window_embedding in enumerate(window_embeddings):
             similarity = cosine_similarity([query_embedding], [window_embedding])[0][0]
 
             if similarity > max_similarity:
                 max_similarity = similarity
-                most_similar_segment = windows[i]
+                most_similar_span = spans[i]
 
-        similarity_scores.append((index, max_similarity, most_similar_segment))
+        similarity_scores.append((index, max_similarity, most_similar_span))
 
     # Sort the papers by similarity score and select top 5
     top_5_papers = sorted(similarity_scores, key=lambda x: x[1], reverse=True)[:5]
 
     # Create a DataFrame for top 5 papers using pandas.concat
-    frames = [dataframe.loc[[idx]].assign(most_similar_segment=segment, similarity_score=score)
-              for idx, score, segment in top_5_papers]
+    # Only the character span of the most similar segment is kept, its text is loaded on demand for display
+    frames = [dataframe.loc[[idx]].assign(segment_start=span[0], segment_end=span[1], similarity_score=score)
+              for idx, score, span in top_5_papers]
     top_5_df = pd.concat(frames)
 
     return top_5_df
 
 """Function to retrieve similar snippets from the text"""
 
-def display_similar_segments(dataframe, paper_name_col):
+def load_segment_text(row, text_col='processed_document', stores=None):
+    return load_row_text(row, text_col, stores)[int(row['segment_start']):int(row['segment_end'])]
+
+def display_similar_segments(dataframe, paper_name_col, text_col='processed_document', stores=None):
     """
     Display the paper name, a snippet from the most similar part of the paper, and the similarity score.
 
-    :param dataframe: The DataFrame containing the papers and their most similar segments.
+    :param dataframe: The DataFrame containing the papers and the spans of their most similar segments.
     :param paper_name_col: The name of the column containing the paper names.
+    :param text_col: The name of the text column the segment spans refer to.
+    :param stores: (Optional) Document stores the results were computed on. Defaults to document_stores.
     """
     for index, row in dataframe.iterrows():
         print(f"Paper: {row[paper_name_col]}")
         print(f"Similarity Score: {row['similarity_score']:.4f}")
 
         # Extract a snippet from the most similar segment (20-30 words)
-        snippet = ' '.join(row['most_similar_segment'].split()[:30])
+        snippet = ' '.join(load_segment_text(row, text_col, stores).split()[:30])
         print(f"Snippet: {snippet}\n")
 
 
 #Usage:display_similar_segments(processed_df, 'paper_name')
+#Usage of the long document modes:
+#process_papers_with_scibert_top_5(df_second_level, 'processed_document', "model", scibert_model, tokenizer, long_document_mode='pooled')
+#benchmark_long_document_modes(df_second_level, ["model", "translation"], scibert_model, tokenizer)
 
 embeddings_cache = load_cache_from_file('embeddings_cache_v3.pkl')
 
@@ -495,31 +1145,63 @@ display_similar_segments(processed_df, 'paper_name')
 
 """# Combined function to retrieve documents using the two-level retrieval system which takes dynamic input"""
 
-def two_level_retrieval_system(df, preprocess_text, level1_func, level2_func, *args, **kwargs):
-    query = input("Enter your query: ")
-    processed_query = preprocess_text(query)
+import functools
 
-    # Apply LDA and TF-IDF
-    lda_document_model, tfidf_vectorizer_document = apply_tfidf_and_lda(df, 'processed_document')
+def function_cache_key(func):
+    # Functions are keyed by identity, so two lambdas never share results; partials by their function and bound arguments
+    if isinstance(func, functools.partial):
+        return (function_cache_key(func.func), func.args, tuple(sorted(func.keywords.items())))
+    return func
+
+def run_two_level_search(processed_query, df, preprocess_text, level1_func, level2_func, *args, **kwargs):
+    """
+    Run both retrieval levels for an already preprocessed query, serving repeated queries from query_result_cache.
+
+    The cache key combines the normalized query, the retrieval functions and parameters (n, weights)
+    and the version of the first level index, so results never outlive the index they were computed on.
+
+    :param processed_query: The query after preprocess_text.
+    :param df: DataFrame containing the documents.
+    :param preprocess_text: Function for preprocessing the queries.
+    :param level1_func: Function for the first level of retrieval.
+    :param level2_func: Function for the second level of retrieval.
+    :return: DataFrame with the final results.
+    """
+    with record_stage('cache_lookup'):
+        index = get_first_level_index(df, 'processed_document')
+
+        cache_key = (index['version'], processed_query, function_cache_key(level1_func), function_cache_key(level2_func), args, tuple(sorted(kwargs.items())))
+        cached_results = cache_get(query_result_cache, cache_key)
+    if cached_results is not None:
+        return cached_results.copy()
 
     # Level 1 Retrieval
-    level1_results = level1_func(
-        query=processed_query,
-        lda_model=lda_document_model,
-        dtm=tfidf_vectorizer_document.transform(df['processed_document']),
-        dataframe=df,
-        vectorizer=tfidf_vectorizer_document,
-        citation_col='citation_count',
-        normalized_col='normalized_score',
-        preprocess_function=preprocess_text,
-        *args,
-        **kwargs
-    )
+    with record_stage('level1'):
+        level1_results = level1_func(
+            query=processed_query,
+            lda_model=index['lda_model'],
+            dtm=index['dtm'],
+            dataframe=df,
+            vectorizer=index['vectorizer'],
+            citation_col='citation_count',
+            normalized_col='normalized_score',
+            preprocess_function=preprocess_text,
+            *args,
+            **kwargs
+        )
 
     # Level 2 Retrieval
-    final_results = level2_func(level1_results, 'processed_document', processed_query, scibert_model, tokenizer)
+    with record_stage('level2'):
+        final_results = level2_func(level1_results, 'processed_document', processed_query, scibert_model, tokenizer)
 
-    return final_results
+    cache_put(query_result_cache, cache_key, final_results)
+    return final_results.copy()
+
+def two_level_retrieval_system(df, preprocess_text, level1_func, level2_func, *args, **kwargs):
+    query = input("Enter your query: ")
+    processed_query = preprocess_text(query)
+
+    return run_two_level_search(processed_query, df, preprocess_text, level1_func, level2_func, *args, **kwargs)
 
 # Make sure new_df and other required components are initialized
 embeddings_cache = load_cache_from_file('embeddings_cache_v3.pkl')
@@ -530,6 +1212,1855 @@ final_results
 
 display_similar_segments(final_results,'paper_name')
 
+"""```
+#Selecting the long document mode of the second level
+chunked_level2 = functools.partial(process_papers_with_scibert_top_5, long_document_mode='chunked')
+final_results = two_level_retrieval_system(new_df, preprocess_text, top_n_papers_refined, chunked_level2)
+```
+"""
+
+"""# Sharded index
+
+The index is split into shards that are persisted as raw binary arrays. Each shard is served by its own worker
+process which memory-maps the shard, and a coordinator scatters every query to all shards and merges their top k.
+Ties are broken by doc id, so the merged results are the same for any number of shards.
+"""
+
+import heapq
+import multiprocessing
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+SHARD_FILES = ['doc_ids.bin', 'doc_topics.bin', 'weighted_score.bin', 'citation_count.bin',
+               'window_ranges.bin', 'window_spans.bin', 'window_embeddings.bin', 'window_norms.bin']
+
+def append_document_to_shard(shard_dir, doc_id, doc_topics, weighted_score, citation_count, window_embeddings, window_spans, codec=None):
+    """
+    Append one document to the arrays of a shard.
+    window_ranges holds the (first window, window count) of each document in the window arrays.
+    If the index has a vector codec, the compressed window vectors are appended as well.
+    """
+    first_window = os.path.getsize(os.path.join(shard_dir, 'window_norms.bin')) // np.dtype(np.float32).itemsize
+
+    append_array(os.path.join(shard_dir, 'doc_ids.bin'), np.array([doc_id], dtype=np.int64))
+    append_array(os.path.join(shard_dir, 'doc_topics.bin'), np.asarray(doc_topics, dtype=np.float64))
+    append_array(os.path.join(shard_dir, 'weighted_score.bin'), np.array([weighted_score], dtype=np.float64))
+    append_array(os.path.join(shard_dir, 'citation_count.bin'), np.array([citation_count], dtype=np.float64))
+    append_array(os.path.join(shard_dir, 'window_ranges.bin'), np.array([first_window, len(window_spans)], dtype=np.int64))
+    append_array(os.path.join(shard_dir, 'window_spans.bin'), np.array(window_spans, dtype=np.int64).reshape(-1, 2))
+    append_array(os.path.join(shard_dir, 'window_embeddings.bin'), window_embeddings.astype(np.float32))
+    append_array(os.path.join(shard_dir, 'window_norms.bin'), np.linalg.norm(window_embeddings, axis=1).astype(np.float32))
+    if codec is not None:
+        append_array(os.path.join(shard_dir, 'window_codes.bin'), encode_vectors(codec, window_embeddings))
+
+def build_sharded_index(dataframe, index_dir, n_shards, model, tokenizer, document_col='processed_document', n_topics_document=10, window_size=512, stride=256, dataset_path=None, first_level=None, long_document_mode='sliding'):
+    """
+    Persist the first and second level index of the corpus as n_shards shards.
+
+    :param dataframe: DataFrame containing the documents (doc_id, folder_name, paper_name, weighted_score, citation_count).
+    :param index_dir: Directory where the index is written.
+    :param n_shards: Number of shards.
+    :param model: SciBERT model used to embed the document windows and summaries.
+    :param tokenizer: Tokenizer for the SciBERT model.
+    :param document_col: Name of the text column to index.
+    :param n_topics_document: Number of LDA topics.
+    :param window_size: The number of tokens in each window.
+    :param stride: The stride between windows.
+    :param dataset_path: (Optional) Dataset folder, recorded so that sync_index only applies later changes. An index built without it cannot be synced.
+    :param first_level: (Optional) Out-of-core first level from build_out_of_core_first_level, built from the current document_col
+                        store. If None, TF-IDF and LDA are fitted in memory.
+    :param long_document_mode: How documents are split into embedded windows ('sliding', 'chunked' or 'pooled').
+    """
+    if first_level is None:
+        index = get_first_level_index(dataframe, document_col, n_topics_document)
+        first_level = {'lda_model': index['lda_model'], 'vectorizer': index['vectorizer']}
+        doc_topics = index['lda_model'].transform(index['dtm'])
+        doc_topic_rows = np.arange(len(dataframe))
+    else:
+        # The on-disk document-topic matrix is indexed by doc id, its rows only match the store it was built from
+        if first_level['meta']['store_version'] != document_stores[document_col]['version']:
+            raise ValueError(f"The out-of-core first level was built from store version {first_level['meta']['store_version']}, "
+                             f"the {document_col} store is at version {document_stores[document_col]['version']}")
+        n_topics_document = first_level['meta']['n_topics']
+        doc_topics = first_level['doc_topics']
+        doc_topic_rows = dataframe['doc_id'].values
+
+    os.makedirs(index_dir, exist_ok=True)
+    with open(os.path.join(index_dir, 'first_level.pkl'), 'wb') as file:
+        pickle.dump({'lda_model': first_level['lda_model'], 'vectorizer': first_level['vectorizer']}, file)
+
+    # The index owns a copy of the document stores, the notebook's stores are rebuilt by every run
+    # while sync_index appends to the index stores and takes new doc ids from them
+    os.makedirs(os.path.join(index_dir, 'store'), exist_ok=True)
+    index_stores = {}
+    for text_col in ['processed_document', 'processed_summary']:
+        for extension in ['.blob', '.offsets', '.version']:
+            shutil.copyfile(document_stores[text_col]['path'] + extension, os.path.join(index_dir, 'store', text_col + extension))
+        index_stores[text_col] = open_document_store(os.path.join(index_dir, 'store', text_col))
+
+    shard_names = [f'shard_{shard_number:03d}' for shard_number in range(n_shards)]
+    meta = {
+        'shards': shard_names,
+        'store_dir': 'store',
+        'document_col': document_col,
+        'n_topics': n_topics_document,
+        'embedding_dim': model.config.hidden_size,
+        'window_size': window_size,
+        'stride': stride,
+        'long_document_mode': long_document_mode,
+        'max_weighted_score': float(dataframe['weighted_score'].max()),
+        'dedup': DEDUP_PARAMS,
+    }
+    with open(os.path.join(index_dir, 'index_meta.json'), 'w') as file:
+        json.dump(meta, file)
+
+    for shard_name, rows in zip(shard_names, np.array_split(np.arange(len(dataframe)), n_shards)):
+        shard_dir = os.path.join(index_dir, shard_name)
+        os.makedirs(shard_dir, exist_ok=True)
+        for file_name in SHARD_FILES:
+            open(os.path.join(shard_dir, file_name), 'wb').close()
+
+        for row_number in rows:
+            row = dataframe.iloc[row_number]
+            embeddings, spans = embed_document_windows(load_row_text(row, document_col, index_stores), model, tokenizer, window_size, stride, long_document_mode)
+            append_document_to_shard(shard_dir, row['doc_id'], doc_topics[doc_topic_rows[row_number]], row['weighted_score'], row['citation_count'], embeddings, spans)
+
+    # Summary embeddings, row i belongs to doc id i of the document store
+    summary_store = index_stores['processed_summary']
+    open(os.path.join(index_dir, 'summary_embeddings.bin'), 'wb').close()
+    for doc_id in range(len(summary_store['offsets']) - 1):
+        append_array(os.path.join(index_dir, 'summary_embeddings.bin'), embed_summary(get_document_text(summary_store, doc_id), model, tokenizer))
+
+    # Deleted doc ids, filtered out by the shard workers until the next compaction
+    open(os.path.join(index_dir, 'tombstones.bin'), 'wb').close()
+
+    documents = dataframe[['doc_id', 'folder_name', 'paper_name', 'weighted_score', 'normalized_score', 'citation_count']].copy().reset_index(drop=True)
+    signatures = scan_dataset_tree(dataset_path) if dataset_path else {}
+    documents['signature'] = documents['folder_name'].map(signatures) if dataset_path else None
+
+    # Folders collapsed into each document at ingestion, recorded so that sync_index does not index them again
+    duplicate_folders = dataframe['duplicate_folders'].tolist() if 'duplicate_folders' in dataframe.columns else [[] for _ in range(len(documents))]
+    documents['duplicate_folders'] = [list(folders) for folders in duplicate_folders]
+    documents['duplicate_signatures'] = [[signatures.get(folder) for folder in folders] for folders in duplicate_folders]
+    documents['minhash'] = list(minhash_signatures(load_column_texts(dataframe, document_col, index_stores), DEDUP_PARAMS['num_perm'], DEDUP_PARAMS['shingle_size']))
+    save_index_documents(index_dir, documents)
+
+def embed_summary(text, model, tokenizer):
+    if not text:
+        return np.zeros((1, model.config.hidden_size), dtype=np.float32)
+    return get_scibert_embeddings([text], model, tokenizer).astype(np.float32)
+
+def load_index_documents(index_dir):
+    """Load the metadata (doc_id, folder_name, paper_name, scores, dataset signature) of the live documents of an index."""
+    return pd.read_pickle(os.path.join(index_dir, 'documents.pkl'))
+
+def index_store_dir(index_dir, meta):
+    # The store directory is recorded relative to the index, so an index can be moved together with its store
+    return os.path.normpath(os.path.join(index_dir, meta['store_dir']))
+
+def save_index_documents(index_dir, documents):
+    documents.to_pickle(os.path.join(index_dir, 'documents.pkl.tmp'))
+    os.replace(os.path.join(index_dir, 'documents.pkl.tmp'), os.path.join(index_dir, 'documents.pkl'))
+
+# Artifacts of the shard served by this worker process
+shard_state = {}
+
+def load_shard(shard_dir):
+    """
+    Worker initializer: memory-map the artifacts of one shard.
+
+    :param shard_dir: Directory of the shard inside the index directory.
+    """
+    global shard_state
+    with open(os.path.join(os.path.dirname(shard_dir), 'index_meta.json')) as file:
+        meta = json.load(file)
+
+    doc_ids = open_memmap_array(os.path.join(shard_dir, 'doc_ids.bin'), np.int64)
+    doc_topics = open_memmap_array(os.path.join(shard_dir, 'doc_topics.bin'), np.float64, meta['n_topics'])
+    tombstones = open_memmap_array(os.path.join(os.path.dirname(shard_dir), 'tombstones.bin'), np.int64)
+    # A document is only served once it is committed to documents.pkl, appends of an interrupted sync are ignored
+    committed_doc_ids = load_index_documents(os.path.dirname(shard_dir))['doc_id'].values
+    shard_state = {
+        'doc_ids': doc_ids,
+        'live': np.isin(doc_ids, committed_doc_ids) & ~np.isin(doc_ids, tombstones),
+        'doc_positions': {doc_id: position for position, doc_id in enumerate(doc_ids.tolist())},
+        'doc_topics': doc_topics,
+        'doc_topic_norms': np.linalg.norm(doc_topics, axis=1),
+        'weighted_score': open_memmap_array(os.path.join(shard_dir, 'weighted_score.bin'), np.float64),
+        'citation_count': open_memmap_array(os.path.join(shard_dir, 'citation_count.bin'), np.float64),
+        'window_ranges': open_memmap_array(os.path.join(shard_dir, 'window_ranges.bin'), np.int64, 2),
+        'window_spans': open_memmap_array(os.path.join(shard_dir, 'window_spans.bin'), np.int64, 2),
+        'window_embeddings': open_memmap_array(os.path.join(shard_dir, 'window_embeddings.bin'), np.float32, meta['embedding_dim']),
+        'window_norms': open_memmap_array(os.path.join(shard_dir, 'window_norms.bin'), np.float32),
+    }
+
+    # Compressed window vectors, scored before the float32 vectors when the index has a vector codec
+    codec = load_vector_codec(os.path.dirname(shard_dir), meta)
+    if codec is not None:
+        shard_state['codec'] = codec
+        shard_state['window_codes'] = open_memmap_array(os.path.join(shard_dir, 'window_codes.bin'), codec['code_dtype'], codec['code_size'])
+
+def select_top_k(scores, doc_ids, k):
+    """
+    Return the positions of the k best scores, sorted by descending score and ascending doc id.
+    All entries tied with the k-th score are considered, so the selection does not depend on how documents are sharded.
+    """
+    if k <= 0 or len(scores) == 0:
+        return np.array([], dtype=np.int64)
+    if len(scores) > k:
+        kth_score = np.partition(scores, len(scores) - k)[len(scores) - k]
+        candidates = np.flatnonzero(scores >= kth_score)
+    else:
+        candidates = np.arange(len(scores))
+    order = np.lexsort((doc_ids[candidates], -scores[candidates]))[:k]
+    return candidates[order]
+
+def search_shard_first_level(query_topics, n, similarity_weight, citation_weight, normalized_weight, max_weighted_score):
+    """Score the documents of this worker's shard like top_n_papers_refined and return its top n as (score, doc_id) pairs."""
+    norms = shard_state['doc_topic_norms'] * np.linalg.norm(query_topics)
+    topic_similarities = np.divide(shard_state['doc_topics'] @ query_topics, norms, out=np.zeros(len(norms)), where=norms > 0)
+    normalized_scores = shard_state['weighted_score'] / max_weighted_score if max_weighted_score else np.zeros(len(norms))
+
+    combined_scores = (similarity_weight * topic_similarities) + \
+                      (citation_weight * shard_state['citation_count']) + \
+                      (normalized_weight * normalized_scores)
+
+    # Deleted documents never reach the second level
+    combined_scores = np.where(shard_state['live'], combined_scores, -np.inf)
+
+    top_positions = select_top_k(combined_scores, shard_state['doc_ids'], n)
+    top_positions = top_positions[np.isfinite(combined_scores[top_positions])]
+    return [(float(combined_scores[position]), int(shard_state['doc_ids'][position])) for position in top_positions]
+
+def best_shard_window(position, query_embedding, compressed=False):
+    """
+    Find the most similar window of the document at the given position of this worker's shard.
+
+    :param position: Position of the document in the shard.
+    :param query_embedding: SciBERT embedding of the query.
+    :param compressed: If True, the window vectors are scored on their compressed codes.
+    :return: (similarity, segment_start, segment_end) of the best window.
+    """
+    first_window, n_windows = shard_state['window_ranges'][position]
+    if n_windows == 0:
+        return 0.0, 0, 0
+
+    norms = shard_state['window_norms'][first_window:first_window + n_windows] * np.linalg.norm(query_embedding)
+    if compressed:
+        dot_products = approximate_dot_products(shard_state['codec'], shard_state['window_codes'][first_window:first_window + n_windows], query_embedding)
+    else:
+        dot_products = shard_state['window_embeddings'][first_window:first_window + n_windows] @ query_embedding
+    similarities = np.divide(dot_products, norms, out=np.zeros(n_windows, dtype=np.float32), where=norms > 0)
+
+    # Same rule as process_papers_with_scibert_top_5: only a positive similarity selects a segment
+    best_window = int(np.argmax(similarities))
+    if similarities[best_window] <= 0:
+        return 0.0, 0, 0
+    span_start, span_end = shard_state['window_spans'][first_window + best_window]
+    return float(similarities[best_window]), int(span_start), int(span_end)
+
+def search_shard_second_level(query_embedding, candidate_doc_ids, top_k, refine_factor=None):
+    """
+    Find the most similar window of each candidate document stored in this worker's shard.
+
+    With refine_factor and a vector codec, the windows are first scored on the compressed vectors, and only the
+    refine_factor * top_k best documents are scored again on the float32 vectors. With refine_factor=0 the
+    compressed scores are final.
+
+    :return: The top_k (similarity, doc_id, segment_start, segment_end) tuples of the shard.
+    """
+    # Documents living in other shards are skipped
+    doc_ids = np.array([doc_id for doc_id in candidate_doc_ids if doc_id in shard_state['doc_positions']], dtype=np.int64)
+    positions = [shard_state['doc_positions'][doc_id] for doc_id in doc_ids.tolist()]
+
+    if refine_factor is not None and 'codec' in shard_state:
+        approximate_results = [best_shard_window(position, query_embedding, compressed=True) for position in positions]
+        approximate_scores = np.array([result[0] for result in approximate_results])
+        if refine_factor == 0:
+            # Compressed vectors only, the float32 vectors are never read
+            return [(approximate_results[index][0], int(doc_ids[index])) + approximate_results[index][1:]
+                    for index in select_top_k(approximate_scores, doc_ids, top_k)]
+        kept = select_top_k(approximate_scores, doc_ids, top_k * refine_factor)
+        doc_ids = doc_ids[kept]
+        positions = [positions[index] for index in kept]
+
+    results = [(similarity, doc_id, segment_start, segment_end)
+               for doc_id, (similarity, segment_start, segment_end)
+               in zip(doc_ids.tolist(), (best_shard_window(position, query_embedding) for position in positions))]
+
+    scores = np.array([result[0] for result in results])
+    return [results[position] for position in select_top_k(scores, doc_ids, top_k)]
+
+def merge_shard_results(shard_results, k):
+    # Results are (score, doc_id, ...) tuples, merged with the same ordering the shards use
+    return heapq.nsmallest(k, (result for results in shard_results for result in results), key=lambda result: (-result[0], result[1]))
+
+def shard_worker_ready():
+    return os.getpid()
+
+# Shard workers are forked, and a fork copies the locks other threads hold at that moment (tokenizer, torch, caches,
+# the queues of the running executors) in their held state. Indexes are opened from background threads
+# (refresh_sharded_index, load_snapshot_in_background) while queries run, so workers are only forked while no
+# sharded query is in flight: new queries wait for the fork and the fork waits for the running queries.
+fork_gate = {'condition': threading.Condition(), 'active_queries': 0, 'forking': False}
+
+@contextmanager
+def sharded_query():
+    with fork_gate['condition']:
+        fork_gate['condition'].wait_for(lambda: not fork_gate['forking'])
+        fork_gate['active_queries'] += 1
+    try:
+        yield
+    finally:
+        with fork_gate['condition']:
+            fork_gate['active_queries'] -= 1
+            fork_gate['condition'].notify_all()
+
+@contextmanager
+def no_queries_in_flight():
+    with fork_gate['condition']:
+        fork_gate['condition'].wait_for(lambda: not fork_gate['forking'])
+        fork_gate['forking'] = True
+        fork_gate['condition'].wait_for(lambda: fork_gate['active_queries'] == 0)
+    try:
+        yield
+    finally:
+        with fork_gate['condition']:
+            fork_gate['forking'] = False
+            fork_gate['condition'].notify_all()
+
+def open_sharded_index(index_dir):
+    """
+    Start one worker process per shard and load the first level models for the coordinator.
+    Safe to call while queries run on another index: the workers are forked once no sharded query is in flight.
+
+    :param index_dir: Directory written by build_sharded_index.
+    :return: Dictionary describing the opened index.
+    """
+    with open(os.path.join(index_dir, 'index_meta.json')) as file:
+        meta = json.load(file)
+    with open(os.path.join(index_dir, 'first_level.pkl'), 'rb') as file:
+        first_level = pickle.load(file)
+
+    # 'fork' because the notebook's functions cannot be re-imported by spawned processes
+    context = multiprocessing.get_context('fork')
+    executors = [
+        ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=load_shard, initargs=(os.path.join(index_dir, shard_name),))
+        for shard_name in meta['shards']
+    ]
+
+    # Workers are forked on the first submit: fork them all now, with no query in flight, then wait for them
+    # outside the gate and surface load errors here
+    with no_queries_in_flight():
+        startup_futures = [executor.submit(shard_worker_ready) for executor in executors]
+    worker_pids = []
+    for shard_name, future in zip(meta['shards'], startup_futures):
+        try:
+            worker_pids.append(future.result())
+        except Exception as error:
+            for executor in executors:
+                executor.shutdown(cancel_futures=True)
+            raise RuntimeError(f"Could not load shard {shard_name} of {index_dir}") from error
+
+    return {'index_dir': index_dir, 'meta': meta, 'lda_model': first_level['lda_model'], 'vectorizer': first_level['vectorizer'],
+            'documents': load_index_documents(index_dir), 'executors': executors, 'worker_pids': worker_pids}
+
+def close_sharded_index(index):
+    for executor in index['executors']:
+        executor.shutdown()
+
+def sharded_search(index, query, model, tokenizer, dataframe=None, n=25, similarity_weight=0.7, citation_weight=0.2, normalized_weight=0.1, top_k=5, refine_factor=4):
+    """
+    Two-level retrieval over a sharded index.
+
+    :param index: Index returned by open_sharded_index.
+    :param query: The user query.
+    :param model: SciBERT model for the query embedding.
+    :param tokenizer: Tokenizer for the SciBERT model.
+    :param dataframe: (Optional) DataFrame with the document metadata (doc_id, paper_name, ...). Defaults to the documents.pkl
+                      of the index, which also holds the papers added by sync_index.
+    :param n: Number of documents kept by the first level.
+    :param similarity_weight: Weight for the LDA topic similarity score.
+    :param citation_weight: Weight for the citation score.
+    :param normalized_weight: Weight for the normalized score.
+    :param top_k: Number of documents returned by the second level.
+    :param refine_factor: With a vector codec, number of candidates per result rescored on the float32 vectors. If None, only float32 vectors are used, if 0 only the compressed vectors.
+    :return: DataFrame of the top_k papers with scores and segment spans.
+    """
+    # No shard worker is forked while the query runs, see fork_gate
+    with sharded_query():
+        with record_stage('preprocess'):
+            processed_query = preprocess_text(query)
+
+        # Level 1: scatter to all shards and merge their top n
+        with record_stage('level1'):
+            query_topics = index['lda_model'].transform(index['vectorizer'].transform([processed_query]))[0]
+            futures = [executor.submit(search_shard_first_level, query_topics, n, similarity_weight, citation_weight,
+                                       normalized_weight, index['meta']['max_weighted_score'])
+                       for executor in index['executors']]
+            level1_results = merge_shard_results([future.result() for future in futures], n)
+            combined_scores = {doc_id: score for score, doc_id in level1_results}
+
+        with record_stage('query_embedding'):
+            query_embedding = get_query_embedding(processed_query, model, tokenizer)
+
+        # Level 2: every shard scores the windows of the candidates it holds
+        with record_stage('level2'):
+            candidate_doc_ids = list(combined_scores)
+            futures = [executor.submit(search_shard_second_level, query_embedding, candidate_doc_ids, top_k, refine_factor)
+                       for executor in index['executors']]
+            level2_results = merge_shard_results([future.result() for future in futures], top_k)
+
+        top_doc_ids = [doc_id for _, doc_id, _, _ in level2_results]
+        dataframe = index['documents'] if dataframe is None else dataframe
+        top_papers = dataframe.set_index('doc_id', drop=False).loc[top_doc_ids].copy()
+        top_papers['combined_score'] = [combined_scores[doc_id] for doc_id in top_doc_ids]
+        top_papers['similarity_score'] = [similarity for similarity, _, _, _ in level2_results]
+        top_papers['segment_start'] = [segment_start for _, _, segment_start, _ in level2_results]
+        top_papers['segment_end'] = [segment_end for _, _, _, segment_end in level2_results]
+
+        return top_papers
+
+def sharded_search_many(index, queries, model, tokenizer, max_concurrent_queries=4, **kwargs):
+    # Several queries in flight keep all shard workers busy
+    with ThreadPoolExecutor(max_workers=max_concurrent_queries) as pool:
+        return list(pool.map(lambda query: sharded_search(index, query, model, tokenizer, **kwargs), queries))
+
+"""```
+#Usage of the sharded index
+build_sharded_index(new_df, 'paperpeek_index', n_shards=4, model=scibert_model, tokenizer=tokenizer)
+sharded_index = open_sharded_index('paperpeek_index')
+
+sharded_results = sharded_search(sharded_index, "model", scibert_model, tokenizer)
+display_similar_segments(sharded_results, 'paper_name')
+
+# An index built with n_shards=1 returns the same documents and scores
+close_sharded_index(sharded_index)
+```
+"""
+
+"""# Incremental index updates
+
+sync_index compares the dataset folder with the state recorded in the index and applies only the changed papers
+to the index (document stores, window embeddings and summary embeddings).
+Deleted papers are tombstoned and removed from the shards by a compaction that can run in the background.
+Doc ids are positions in the index stores and are never reused: compaction empties the texts of deleted documents
+but keeps their store offsets and summary embedding rows, which keep their (small) space until the index is rebuilt.
+"""
+
+import fcntl
+import threading
+
+# Syncs, compactions, codec changes and snapshot copies of an index must not run at the same time
+index_write_lock = threading.Lock()
+
+@contextmanager
+def index_file_lock(index_dir):
+    """
+    Hold the write lock of an index, for the threads of this process and for other processes (another notebook,
+    a scheduled sync) working on the same directory.
+
+    :param index_dir: Directory of the sharded index, the lock file is index_dir/.lock.
+    """
+    # flock locks are per open file, so the thread lock is still needed between the threads of this process
+    with index_write_lock:
+        with open(os.path.join(index_dir, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def scan_dataset_tree(dataset_path):
+    """
+    Return a signature for every paper folder of the dataset, built from the names, sizes and modification times of its files.
+
+    :param dataset_path: Path of the dataset folder.
+    :return: Dictionary mapping folder names to signatures.
+    """
+    signatures = {}
+    for folder_name in sorted(os.listdir(dataset_path)):
+        folder_path = os.path.join(dataset_path, folder_name)
+        if not os.path.isdir(folder_path):
+            continue
+
+        digest = hashlib.sha1()
+        for root, dirs, files in os.walk(folder_path):
+            dirs.sort()
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                file_stat = os.stat(file_path)
+                digest.update(f"{os.path.relpath(file_path, folder_path)}|{file_stat.st_size}|{file_stat.st_mtime_ns}\n".encode())
+        signatures[folder_name] = digest.hexdigest()
+
+    return signatures
+
+def load_index_meta(index_dir):
+    with open(os.path.join(index_dir, 'index_meta.json')) as file:
+        return json.load(file)
+
+def save_index_meta(index_dir, meta):
+    with open(os.path.join(index_dir, 'index_meta.json.tmp'), 'w') as file:
+        json.dump(meta, file)
+    os.replace(os.path.join(index_dir, 'index_meta.json.tmp'), os.path.join(index_dir, 'index_meta.json'))
+
+def check_index_doc_ids(index_dir, meta, documents):
+    """
+    Check that the document stores, the summary embeddings and the shards of an index agree on the doc ids,
+    so that new documents get fresh doc ids and row i of summary_embeddings.bin stays doc id i.
+
+    :param index_dir: Directory of the sharded index.
+    :param meta: Index metadata.
+    :param documents: Metadata of the live documents.
+    :return: Number of doc ids handed out so far.
+    """
+    store_path = index_store_dir(index_dir, meta)
+    n_store_docs = [len(open_memmap_array(os.path.join(store_path, text_col + '.offsets'), np.int64)) - 1
+                    for text_col in ['processed_document', 'processed_summary']]
+    n_summary_rows = len(open_memmap_array(os.path.join(index_dir, 'summary_embeddings.bin'), np.float32, meta['embedding_dim']))
+    shard_doc_ids = [open_memmap_array(os.path.join(index_dir, shard_name, 'doc_ids.bin'), np.int64) for shard_name in meta['shards']]
+    max_doc_id = max([int(doc_ids.max()) for doc_ids in shard_doc_ids if len(doc_ids)] + [int(documents['doc_id'].max()) if len(documents) else -1])
+
+    # After a compaction the highest doc ids may belong to deleted documents, so max_doc_id + 1 can be smaller
+    if n_store_docs[0] != n_store_docs[1] or n_store_docs[0] != n_summary_rows or max_doc_id + 1 > n_store_docs[0]:
+        raise ValueError(f"Index {index_dir} is inconsistent: {n_store_docs[0]} documents and {n_store_docs[1]} summaries in the stores, "
+                         f"{n_summary_rows} summary embeddings, highest doc id {max_doc_id}. Rebuild the index before syncing it.")
+    return n_store_docs[0]
+
+def load_complete_paper(folder_path):
+    """
+    Load a paper folder and check that it can be indexed, e.g. that it is not still being copied.
+
+    :param folder_path: Path of the paper folder.
+    :return: The paper dictionary from load_paper_folder.
+    """
+    paper = load_paper_folder(folder_path)
+    missing = [part for part in ['document', 'summary'] if not paper[part]] + (['citation'] if paper['citation'] is None else [])
+    if missing:
+        raise ValueError(f"Incomplete paper folder {folder_path}, missing: {', '.join(missing)}")
+    return paper
+
+def checkpoint_files(paths):
+    # Sizes of append-only files and contents of rewritten files, enough to undo a partial write
+    checkpoint = {}
+    for path in paths:
+        if path.endswith('.version'):
+            with open(path) as file:
+                checkpoint[path] = file.read()
+        elif os.path.exists(path):
+            checkpoint[path] = os.path.getsize(path)
+    return checkpoint
+
+def restore_files(checkpoint):
+    for path, state in checkpoint.items():
+        if isinstance(state, str):
+            with open(path, 'w') as file:
+                file.write(state)
+        else:
+            os.truncate(path, state)
+
+def index_paper(index_dir, meta, first_level, paper, model, tokenizer, duplicate_candidates=None):
+    """
+    Add one paper to the document stores, a shard and the summary embeddings.
+    Everything is computed before the first write, and a failing write undoes the appends of the paper,
+    so the stores, shards and summary embeddings stay aligned on doc ids.
+    A near-duplicate of an indexed document is not written at all.
+
+    :param index_dir: Directory of the sharded index.
+    :param meta: Index metadata.
+    :param first_level: Fitted LDA model and TF-IDF vectorizer of the index.
+    :param paper: Paper dictionary from load_complete_paper.
+    :param model: SciBERT model for the window and summary embeddings.
+    :param tokenizer: Tokenizer for the SciBERT model.
+    :param duplicate_candidates: (Optional) Indexed documents ('doc_id' and 'minhash' columns) the paper is checked against.
+    :return: Dictionary with the metadata of the new document, or with 'duplicate_of' (the doc id it duplicates).
+    """
+    processed_document = preprocess_text(paper['document'])
+    processed_summary = preprocess_text(paper['summary'])
+
+    # Same signatures and LSH parameters as collapse_near_duplicates at ingestion
+    dedup = meta.get('dedup', DEDUP_PARAMS)
+    signature = minhash_signatures([processed_document], dedup['num_perm'], dedup['shingle_size'])[0]
+    if duplicate_candidates is not None and len(duplicate_candidates):
+        position = find_indexed_duplicate(signature, np.stack(duplicate_candidates['minhash'].values), dedup['n_bands'], dedup['threshold'])
+        if position is not None:
+            return {'duplicate_of': int(duplicate_candidates['doc_id'].iloc[position]), 'minhash': signature}
+
+    # The first level models are not refitted, new documents are projected with the existing vocabulary and topics
+    doc_topics = first_level['lda_model'].transform(first_level['vectorizer'].transform([processed_document]))[0]
+
+    citations = paper['citation']
+    weighted_score = calculate_weighted_score(citations)
+    citation_count = extract_citation_count([citation.get('citance_No') for citation in citations])
+
+    codec = load_vector_codec(index_dir, meta)
+    embeddings, spans = embed_document_windows(processed_document, model, tokenizer, meta['window_size'], meta['stride'], meta['long_document_mode'])
+    summary_embedding = embed_summary(processed_summary, model, tokenizer)
+
+    # New documents go to the smallest shard
+    shard_name = min(meta['shards'], key=lambda name: os.path.getsize(os.path.join(index_dir, name, 'doc_ids.bin')))
+    shard_dir = os.path.join(index_dir, shard_name)
+    store_paths = [os.path.join(index_store_dir(index_dir, meta), text_col) for text_col in ['processed_document', 'processed_summary']]
+    checkpoint = checkpoint_files(
+        [os.path.join(shard_dir, file_name) for file_name in SHARD_FILES + ['window_codes.bin']] +
+        [store_path + extension for store_path in store_paths for extension in ['.blob', '.offsets', '.version']] +
+        [os.path.join(index_dir, file_name) for file_name in ['summary_embeddings.bin', 'summary_codes.bin', 'summary_norms.bin']]
+    )
+
+    try:
+        # Both stores are appended together, so the doc id is the same in each
+        doc_id = append_to_document_store(store_paths[0], processed_document)
+        append_to_document_store(store_paths[1], processed_summary)
+
+        append_document_to_shard(shard_dir, doc_id, doc_topics, weighted_score, citation_count, embeddings, spans, codec)
+
+        append_array(os.path.join(index_dir, 'summary_embeddings.bin'), summary_embedding)
+        if codec is not None:
+            append_array(os.path.join(index_dir, 'summary_codes.bin'), encode_vectors(codec, summary_embedding))
+            append_array(os.path.join(index_dir, 'summary_norms.bin'), np.linalg.norm(summary_embedding, axis=1).astype(np.float32))
+    except BaseException:
+        restore_files(checkpoint)
+        raise
+
+    return {
+        'doc_id': doc_id,
+        'paper_name': extract_paper_name(paper['summary']),
+        'weighted_score': weighted_score,
+        'citation_count': citation_count,
+        'minhash': signature,
+    }
+
+def sync_index(dataset_path, index_dir, model, tokenizer):
+    """
+    Apply the papers added, updated and deleted in the dataset folder since the last build or sync to the index.
+    An updated paper is indexed again under a new doc id and its old version is tombstoned.
+
+    New and updated papers are checked against the MinHash signatures of the indexed documents. A near-duplicate
+    is not indexed, its folder is recorded on the document it duplicates and the citations are merged. Copies
+    recorded this way are skipped while unchanged; a changed or deleted copy is taken off its document.
+
+    Every paper is committed on its own: its appends, tombstone, documents.pkl entry and metadata are saved
+    before the next paper starts. Folders that cannot be indexed (e.g. still being copied) are skipped and
+    retried at the next sync.
+
+    :param dataset_path: Path of the dataset folder.
+    :param index_dir: Directory of the sharded index.
+    :param model: SciBERT model for the window and summary embeddings.
+    :param tokenizer: Tokenizer for the SciBERT model.
+    :return: Dictionary with the lists of added, updated, deleted, duplicate and failed folder names.
+    """
+    with index_file_lock(index_dir):
+        meta = load_index_meta(index_dir)
+        with open(os.path.join(index_dir, 'first_level.pkl'), 'rb') as file:
+            first_level = pickle.load(file)
+        documents = load_index_documents(index_dir).reset_index(drop=True)
+        check_index_doc_ids(index_dir, meta, documents)
+
+        # Without the recorded dataset state every folder would look changed and the whole corpus would be indexed again
+        recorded_signatures = list(documents['signature']) + [signature for folder_signatures in documents['duplicate_signatures'] for signature in folder_signatures]
+        if any(pd.isna(signature) for signature in recorded_signatures):
+            raise ValueError(f"Index {index_dir} has no recorded dataset state, build it with dataset_path to sync it")
+
+        signatures = scan_dataset_tree(dataset_path)
+        known_signatures = dict(zip(documents['folder_name'], documents['signature']))
+        copy_signatures = {folder: signature
+                           for folders, folder_signatures in zip(documents['duplicate_folders'], documents['duplicate_signatures'])
+                           for folder, signature in zip(folders, folder_signatures)}
+
+        added = [name for name in signatures if name not in known_signatures and name not in copy_signatures]
+        updated = [name for name in signatures if name in known_signatures and signatures[name] != known_signatures[name]]
+        deleted = [name for name in known_signatures if name not in signatures]
+        changed_copies = [name for name in copy_signatures if signatures.get(name) != copy_signatures[name]]
+
+        def commit(documents, tombstoned_doc_ids):
+            # Tombstones first: a crash before documents.pkl is saved only repeats them at the next sync
+            append_array(os.path.join(index_dir, 'tombstones.bin'), np.asarray(tombstoned_doc_ids, dtype=np.int64))
+
+            # The normalization maximum only grows between compactions, so the scores of existing documents stay valid
+            if len(documents):
+                meta['max_weighted_score'] = max(meta['max_weighted_score'], float(documents['weighted_score'].max()))
+            if meta['max_weighted_score']:
+                documents['normalized_score'] = documents['weighted_score'] / meta['max_weighted_score']
+            save_index_meta(index_dir, meta)
+            save_index_documents(index_dir, documents)
+
+        removed = documents['folder_name'].isin(deleted)
+        if removed.any():
+            # Copies of a deleted document are checked again like new papers
+            for folders in documents.loc[removed, 'duplicate_folders']:
+                added += [folder for folder in folders if folder in signatures and folder not in changed_copies]
+            tombstoned_doc_ids = documents.loc[removed, 'doc_id'].values
+            documents = documents[~removed].reset_index(drop=True)
+            commit(documents, tombstoned_doc_ids)
+
+        # Changed and deleted copies are taken off their document, changed ones are checked again like new papers
+        for folder_name in changed_copies:
+            position = next((position for position, folders in enumerate(documents['duplicate_folders']) if folder_name in folders), None)
+            if position is not None:
+                remove_duplicate_folder(documents, position, folder_name)
+                refresh_merged_citations(dataset_path, index_dir, meta, documents, position)
+                commit(documents, [])
+            if folder_name in signatures:
+                added.append(folder_name)
+
+        applied_added, applied_updated, duplicates, failed = [], [], [], []
+        for folder_name in added + updated:
+            print("Indexing paper:", folder_name)
+            replaced = documents['folder_name'] == folder_name
+            try:
+                paper = load_complete_paper(os.path.join(dataset_path, folder_name))
+                row = index_paper(index_dir, meta, first_level, paper, model, tokenizer, duplicate_candidates=documents[~replaced])
+            except Exception as error:
+                print(f"Skipping paper {folder_name}: {error!r}")
+                failed.append(folder_name)
+                continue
+
+            # The old version of an updated paper is tombstoned together with the new entry, and its copies move with it
+            tombstoned_doc_ids = documents.loc[replaced, 'doc_id'].values
+            carried_folders = [folder for folders in documents.loc[replaced, 'duplicate_folders'] for folder in folders]
+            carried_signatures = [signature for folder_signatures in documents.loc[replaced, 'duplicate_signatures'] for signature in folder_signatures]
+            documents = documents[~replaced].reset_index(drop=True)
+
+            if 'duplicate_of' in row:
+                position = int(np.flatnonzero(documents['doc_id'].values == row['duplicate_of'])[0])
+                print(f"Near-duplicate of {documents['folder_name'].iloc[position]}, not indexed")
+                for folder, signature in [(folder_name, signatures[folder_name])] + list(zip(carried_folders, carried_signatures)):
+                    add_duplicate_folder(documents, position, folder, signature)
+                refresh_merged_citations(dataset_path, index_dir, meta, documents, position)
+                commit(documents, tombstoned_doc_ids)
+                duplicates.append(folder_name)
+                continue
+
+            row['folder_name'] = folder_name
+            row['signature'] = signatures[folder_name]
+            row['duplicate_folders'] = carried_folders
+            row['duplicate_signatures'] = carried_signatures
+            documents = pd.concat([documents, pd.DataFrame([row])], ignore_index=True)
+            if carried_folders:
+                refresh_merged_citations(dataset_path, index_dir, meta, documents, len(documents) - 1)
+            commit(documents, tombstoned_doc_ids)
+            (applied_updated if folder_name in known_signatures else applied_added).append(folder_name)
+
+        for text_col in ['processed_document', 'processed_summary']:
+            document_stores[text_col] = open_document_store(os.path.join(index_store_dir(index_dir, meta), text_col))
+
+    return {'added': applied_added, 'updated': applied_updated, 'deleted': deleted, 'duplicates': duplicates, 'failed': failed}
+
+def set_document_value(documents, position, column, value):
+    # Column-wise assignment, list values cannot be set through .at
+    values = documents[column].tolist()
+    values[position] = value
+    documents[column] = values
+
+def add_duplicate_folder(documents, position, folder_name, signature):
+    set_document_value(documents, position, 'duplicate_folders', list(documents['duplicate_folders'].iloc[position]) + [folder_name])
+    set_document_value(documents, position, 'duplicate_signatures', list(documents['duplicate_signatures'].iloc[position]) + [signature])
+
+def remove_duplicate_folder(documents, position, folder_name):
+    kept = [(folder, signature) for folder, signature in zip(documents['duplicate_folders'].iloc[position], documents['duplicate_signatures'].iloc[position])
+            if folder != folder_name]
+    set_document_value(documents, position, 'duplicate_folders', [folder for folder, _ in kept])
+    set_document_value(documents, position, 'duplicate_signatures', [signature for _, signature in kept])
+
+def update_shard_scores(index_dir, meta, doc_id, weighted_score, citation_count):
+    # Scores are rewritten in place, shard workers map the same files and see the new values
+    for shard_name in meta['shards']:
+        shard_dir = os.path.join(index_dir, shard_name)
+        positions = np.flatnonzero(open_memmap_array(os.path.join(shard_dir, 'doc_ids.bin'), np.int64) == doc_id)
+        if len(positions):
+            for file_name, value in [('weighted_score.bin', weighted_score), ('citation_count.bin', citation_count)]:
+                values = open_memmap_array(os.path.join(shard_dir, file_name), np.float64, mode='r+')
+                values[positions[-1]] = value
+                values.flush()
+            return
+
+def refresh_merged_citations(dataset_path, index_dir, meta, documents, position):
+    """
+    Recompute the scores of an indexed document from the merged citations of its folder and its near-duplicate folders.
+
+    :param dataset_path: Path of the dataset folder.
+    :param index_dir: Directory of the sharded index.
+    :param meta: Index metadata.
+    :param documents: Metadata of the live documents, updated in place.
+    :param position: Row of the document in documents.
+    """
+    folders = [documents['folder_name'].iloc[position]] + list(documents['duplicate_folders'].iloc[position])
+    citations = merge_citations([load_paper_folder(os.path.join(dataset_path, folder))['citation']
+                                 for folder in folders if os.path.isdir(os.path.join(dataset_path, folder))])
+    weighted_score = calculate_weighted_score(citations)
+    citation_count = extract_citation_count([citation.get('citance_No') for citation in citations])
+
+    update_shard_scores(index_dir, meta, int(documents['doc_id'].iloc[position]), weighted_score, citation_count)
+    set_document_value(documents, position, 'weighted_score', weighted_score)
+    set_document_value(documents, position, 'citation_count', citation_count)
+
+def compact_sharded_index(index_dir):
+    """
+    Rewrite the shards and document stores without the tombstoned documents and clear the tombstones.
+
+    :param index_dir: Directory of the sharded index.
+    """
+    with index_file_lock(index_dir):
+        meta = load_index_meta(index_dir)
+        documents = load_index_documents(index_dir)
+        tombstones = set(open_memmap_array(os.path.join(index_dir, 'tombstones.bin'), np.int64).tolist())
+        if not tombstones:
+            return
+        codec = load_vector_codec(index_dir, meta)
+        live_doc_ids = set(documents['doc_id'].tolist())
+
+        for shard_name in meta['shards']:
+            shard_dir = os.path.join(index_dir, shard_name)
+            compact_dir = shard_dir + '.compacting'
+            os.makedirs(compact_dir, exist_ok=True)
+            for file_name in SHARD_FILES + (['window_codes.bin'] if codec is not None else []):
+                open(os.path.join(compact_dir, file_name), 'wb').close()
+
+            doc_ids = open_memmap_array(os.path.join(shard_dir, 'doc_ids.bin'), np.int64)
+            doc_topics = open_memmap_array(os.path.join(shard_dir, 'doc_topics.bin'), np.float64, meta['n_topics'])
+            weighted_scores = open_memmap_array(os.path.join(shard_dir, 'weighted_score.bin'), np.float64)
+            citation_counts = open_memmap_array(os.path.join(shard_dir, 'citation_count.bin'), np.float64)
+            window_ranges = open_memmap_array(os.path.join(shard_dir, 'window_ranges.bin'), np.int64, 2)
+            window_spans = open_memmap_array(os.path.join(shard_dir, 'window_spans.bin'), np.int64, 2)
+            window_embeddings = open_memmap_array(os.path.join(shard_dir, 'window_embeddings.bin'), np.float32, meta['embedding_dim'])
+
+            for position, doc_id in enumerate(doc_ids.tolist()):
+                # Uncommitted appends of an interrupted sync are dropped with the tombstoned documents
+                if doc_id in tombstones or doc_id not in live_doc_ids:
+                    continue
+                first_window, n_windows = window_ranges[position]
+                append_document_to_shard(compact_dir, doc_id, doc_topics[position], weighted_scores[position], citation_counts[position],
+                                         window_embeddings[first_window:first_window + n_windows],
+                                         window_spans[first_window:first_window + n_windows], codec)
+
+            # Workers still mapping the old files keep reading them until they are refreshed
+            os.rename(shard_dir, shard_dir + '.old')
+            os.rename(compact_dir, shard_dir)
+            shutil.rmtree(shard_dir + '.old')
+
+        for text_col in ['processed_document', 'processed_summary']:
+            document_stores[text_col] = compact_document_store(os.path.join(index_store_dir(index_dir, meta), text_col), live_doc_ids)
+
+        meta['max_weighted_score'] = float(documents['weighted_score'].max())
+        if meta['max_weighted_score']:
+            documents['normalized_score'] = documents['weighted_score'] / meta['max_weighted_score']
+        save_index_meta(index_dir, meta)
+        save_index_documents(index_dir, documents)
+
+        open(os.path.join(index_dir, 'tombstones.bin'), 'wb').close()
+
+def start_background_compaction(index_dir):
+    compaction_thread = threading.Thread(target=compact_sharded_index, args=(index_dir,), daemon=True)
+    compaction_thread.start()
+    return compaction_thread
+
+def refresh_sharded_index(index):
+    """Restart the shard workers of an opened index so they map the current shard files and tombstones."""
+    refreshed_index = open_sharded_index(index['index_dir'])
+    # Swapped between queries, so that no query submits to the old workers once they are shut down
+    with no_queries_in_flight():
+        old_executors = index['executors']
+        index.update(refreshed_index)
+    for executor in old_executors:
+        executor.shutdown()
+
+def watch_dataset(dataset_path, index_dir, model, tokenizer, sharded_index=None, interval_seconds=60, compaction_threshold=100):
+    """
+    Keep the index in sync with the dataset folder.
+
+    :param dataset_path: Path of the dataset folder.
+    :param index_dir: Directory of the sharded index.
+    :param model: SciBERT model for the window and summary embeddings.
+    :param tokenizer: Tokenizer for the SciBERT model.
+    :param sharded_index: (Optional) Opened index whose workers are refreshed after every change.
+    :param interval_seconds: Time between two scans of the dataset folder.
+    :param compaction_threshold: Number of tombstones that starts a background compaction.
+    """
+    compaction_thread = None
+    while True:
+        try:
+            changes = sync_index(dataset_path, index_dir, model, tokenizer)
+        except Exception as error:
+            # The paper being committed is rolled back, the next scan retries it
+            print(f"Sync of {dataset_path} failed: {error!r}")
+            changes = {}
+        if changes.get('failed'):
+            print("Papers not indexed yet:", changes['failed'])
+        if any(changes.get(change) for change in ['added', 'updated', 'deleted', 'duplicates']):
+            print(f"Added: {len(changes['added'])}, updated: {len(changes['updated'])}, deleted: {len(changes['deleted'])}, "
+                  f"near-duplicates: {len(changes['duplicates'])}")
+            if sharded_index is not None:
+                try:
+                    refresh_sharded_index(sharded_index)
+                except Exception as error:
+                    # The index keeps serving with its current workers, the next change retries the refresh
+                    print(f"Refresh of the shard workers failed: {error!r}")
+
+        n_tombstones = os.path.getsize(os.path.join(index_dir, 'tombstones.bin')) // np.dtype(np.int64).itemsize
+        if n_tombstones >= compaction_threshold and (compaction_thread is None or not compaction_thread.is_alive()):
+            compaction_thread = start_background_compaction(index_dir)
+
+        time.sleep(interval_seconds)
+
+"""```
+#Usage of the incremental updates
+build_sharded_index(new_df, 'paperpeek_index', n_shards=4, model=scibert_model, tokenizer=tokenizer, dataset_path=dataset_path)
+sharded_index = open_sharded_index('paperpeek_index')
+
+# After adding, changing or removing paper folders in the dataset
+sync_index(dataset_path, 'paperpeek_index', scibert_model, tokenizer)
+refresh_sharded_index(sharded_index)
+sharded_results = sharded_search(sharded_index, "model", scibert_model, tokenizer)
+
+# Or keep watching the dataset folder
+watch_dataset(dataset_path, 'paperpeek_index', scibert_model, tokenizer, sharded_index=sharded_index)
+```
+"""
+
+"""# Compressed vector storage
+
+Window and summary embeddings can be stored as float16, int8 (per dimension scalar quantization) or product
+quantization codes. Level 2 scores the compressed codes first and rescores only the best candidates on the
+float32 vectors, which stay on disk and are only paged in for those candidates.
+"""
+
+from sklearn.cluster import MiniBatchKMeans
+
+def train_vector_codec(sample, codec_name='int8', n_subspaces=96, n_centroids=256):
+    """
+    Fit the parameters of a vector codec on a sample of embeddings.
+
+    :param sample: 2D array of float32 embeddings.
+    :param codec_name: 'float16', 'int8' or 'pq' (product quantization).
+    :param n_subspaces: Number of subspaces for product quantization, must divide the embedding size.
+    :param n_centroids: Number of centroids per subspace for product quantization (at most 256, and at most the sample size).
+    :return: Dictionary describing the codec.
+    """
+    dim = sample.shape[1]
+    if codec_name == 'float16':
+        return {'name': codec_name, 'dim': dim, 'code_dtype': 'float16', 'code_size': dim}
+
+    if codec_name == 'int8':
+        offset = sample.min(axis=0)
+        scale = (sample.max(axis=0) - offset) / 255
+        scale[scale == 0] = 1
+        return {'name': codec_name, 'dim': dim, 'code_dtype': 'uint8', 'code_size': dim,
+                'offset': offset.astype(np.float32), 'scale': scale.astype(np.float32)}
+
+    if codec_name == 'pq':
+        # Checked before any k-means runs, so that compress_sharded_index fails before writing anything
+        if n_subspaces <= 0 or dim % n_subspaces != 0:
+            raise ValueError(f"n_subspaces ({n_subspaces}) must divide the embedding size ({dim})")
+        if not 1 <= n_centroids <= 256:
+            raise ValueError(f"n_centroids ({n_centroids}) must be between 1 and 256, the codes are stored as uint8")
+        if len(sample) < n_centroids:
+            raise ValueError(f"Product quantization needs at least n_centroids ({n_centroids}) sample vectors, got {len(sample)}")
+        subspace_dim = dim // n_subspaces
+        centroids = np.stack([
+            MiniBatchKMeans(n_clusters=n_centroids, random_state=0, n_init=3)
+            .fit(sample[:, subspace * subspace_dim:(subspace + 1) * subspace_dim]).cluster_centers_
+            for subspace in range(n_subspaces)
+        ])
+        return {'name': codec_name, 'dim': dim, 'code_dtype': 'uint8', 'code_size': n_subspaces,
+                'centroids': centroids.astype(np.float32)}
+
+    raise ValueError(f"Unknown vector codec: {codec_name}")
+
+def encode_vectors(codec, vectors):
+    vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, codec['dim'])
+    if codec['name'] == 'float16':
+        return vectors.astype(np.float16)
+
+    if codec['name'] == 'int8':
+        return np.clip(np.rint((vectors - codec['offset']) / codec['scale']), 0, 255).astype(np.uint8)
+
+    # Product quantization: index of the nearest centroid in every subspace
+    n_subspaces, _, subspace_dim = codec['centroids'].shape
+    codes = np.empty((len(vectors), n_subspaces), dtype=np.uint8)
+    for subspace in range(n_subspaces):
+        subvectors = vectors[:, subspace * subspace_dim:(subspace + 1) * subspace_dim]
+        centroids = codec['centroids'][subspace]
+        # Squared distances up to the per-vector constant |x|^2, which does not change the argmin
+        distances = (centroids ** 2).sum(axis=1) - 2 * subvectors @ centroids.T
+        codes[:, subspace] = distances.argmin(axis=1)
+    return codes
+
+def approximate_dot_products(codec, codes, query):
+    """
+    Dot products between a float32 query and compressed vectors, computed without decompressing the vectors.
+
+    :param codec: The vector codec.
+    :param codes: 2D array of codes.
+    :param query: 1D float32 query vector.
+    :return: 1D array of approximate dot products.
+    """
+    query = np.asarray(query, dtype=np.float32)
+    if codec['name'] == 'float16':
+        return np.asarray(codes, dtype=np.float32) @ query
+
+    if codec['name'] == 'int8':
+        # q . x = q . (offset + scale * code)
+        return np.asarray(codes, dtype=np.float32) @ (query * codec['scale']) + query @ codec['offset']
+
+    # Asymmetric distance computation: one lookup table of query-centroid dot products per subspace
+    n_subspaces, _, subspace_dim = codec['centroids'].shape
+    lookup_tables = np.einsum('mkd,md->mk', codec['centroids'], query.reshape(n_subspaces, subspace_dim))
+    return lookup_tables[np.arange(n_subspaces), np.asarray(codes)].sum(axis=1)
+
+def load_vector_codec(index_dir, meta):
+    if not meta.get('vector_codec'):
+        return None
+    with open(os.path.join(index_dir, 'vector_codec.pkl'), 'rb') as file:
+        return pickle.load(file)
+
+def encode_array_file(codec, source_path, target_path, chunk_size=65536):
+    """Encode a raw float32 vector file in chunks into a code file."""
+    vectors = open_memmap_array(source_path, np.float32, codec['dim'])
+    open(target_path + '.tmp', 'wb').close()
+    for start in range(0, len(vectors), chunk_size):
+        append_array(target_path + '.tmp', encode_vectors(codec, vectors[start:start + chunk_size]))
+    os.replace(target_path + '.tmp', target_path)
+
+def compress_sharded_index(index_dir, codec_name='int8', sample_size=100000, **codec_params):
+    """
+    Train a vector codec on a sample of the window embeddings and write the compressed window and summary vectors.
+
+    :param index_dir: Directory of the sharded index.
+    :param codec_name: 'float16', 'int8' or 'pq'.
+    :param sample_size: Number of window embeddings used to train the codec.
+    :param codec_params: Extra parameters for train_vector_codec (n_subspaces, n_centroids).
+    """
+    with index_file_lock(index_dir):
+        meta = load_index_meta(index_dir)
+        shard_embeddings = [open_memmap_array(os.path.join(index_dir, shard_name, 'window_embeddings.bin'), np.float32, meta['embedding_dim'])
+                            for shard_name in meta['shards']]
+
+        # Sample every shard in proportion to its size
+        rng = np.random.default_rng(0)
+        n_windows = sum(len(embeddings) for embeddings in shard_embeddings)
+        sample = np.concatenate([
+            embeddings[np.sort(rng.choice(len(embeddings), size=min(len(embeddings), max(1, sample_size * len(embeddings) // n_windows)), replace=False))]
+            for embeddings in shard_embeddings if len(embeddings)
+        ])
+        codec = train_vector_codec(sample, codec_name, **codec_params)
+
+        for shard_name in meta['shards']:
+            shard_dir = os.path.join(index_dir, shard_name)
+            encode_array_file(codec, os.path.join(shard_dir, 'window_embeddings.bin'), os.path.join(shard_dir, 'window_codes.bin'))
+
+        encode_array_file(codec, os.path.join(index_dir, 'summary_embeddings.bin'), os.path.join(index_dir, 'summary_codes.bin'))
+        summary_embeddings = open_memmap_array(os.path.join(index_dir, 'summary_embeddings.bin'), np.float32, meta['embedding_dim'])
+        np.linalg.norm(summary_embeddings, axis=1).astype(np.float32).tofile(os.path.join(index_dir, 'summary_norms.bin'))
+
+        with open(os.path.join(index_dir, 'vector_codec.pkl'), 'wb') as file:
+            pickle.dump(codec, file)
+        meta['vector_codec'] = codec_name
+        save_index_meta(index_dir, meta)
+
+def remove_vector_codec(index_dir):
+    with index_file_lock(index_dir):
+        meta = load_index_meta(index_dir)
+        meta['vector_codec'] = None
+        save_index_meta(index_dir, meta)
+
+def find_relevant_docs_from_summary_store(query, index_dir, model, tokenizer, top_n=35, refine_factor=4):
+    """
+    Find relevant documents for a query from the persisted summary embeddings of an index.
+
+    :param query: The query string.
+    :param index_dir: Directory of the sharded index.
+    :param model: SciBERT model for the query embedding.
+    :param tokenizer: Tokenizer for the SciBERT model.
+    :param top_n: Number of top relevant documents to return.
+    :param refine_factor: With a vector codec, number of candidates per result rescored on the float32 vectors, 0 to use the compressed vectors only.
+    :return: Doc ids of the top_n relevant documents.
+    """
+    meta = load_index_meta(index_dir)
+    codec = load_vector_codec(index_dir, meta)
+    candidate_doc_ids = np.sort(load_index_documents(index_dir)['doc_id'].values.astype(np.int64))
+    query_embedding = get_query_embedding(query, model, tokenizer)
+
+    if codec is not None:
+        summary_codes = open_memmap_array(os.path.join(index_dir, 'summary_codes.bin'), codec['code_dtype'], codec['code_size'])
+        summary_norms = open_memmap_array(os.path.join(index_dir, 'summary_norms.bin'), np.float32)
+        norms = summary_norms[candidate_doc_ids] * np.linalg.norm(query_embedding)
+        approximate_similarities = np.divide(approximate_dot_products(codec, summary_codes[candidate_doc_ids], query_embedding), norms,
+                                             out=np.zeros(len(norms), dtype=np.float32), where=norms > 0)
+        if refine_factor == 0:
+            return candidate_doc_ids[select_top_k(approximate_similarities, candidate_doc_ids, top_n)].tolist()
+        candidate_doc_ids = candidate_doc_ids[select_top_k(approximate_similarities, candidate_doc_ids, top_n * refine_factor)]
+
+    summary_embeddings = open_memmap_array(os.path.join(index_dir, 'summary_embeddings.bin'), np.float32, meta['embedding_dim'])
+    similarities = cosine_similarity([query_embedding], summary_embeddings[candidate_doc_ids])[0]
+    return candidate_doc_ids[select_top_k(similarities, candidate_doc_ids, top_n)].tolist()
+
+def compare_vector_codecs(index_dir, queries, model, tokenizer, codec_names=('float16', 'int8', 'pq'), top_k=5, refine_factor=4):
+    """
+    Report the memory used by the compressed window vectors against the top_k agreement with float32 scoring.
+    The codecs are trained on a copy of the index, the index itself is left untouched.
+
+    :param index_dir: Directory of the sharded index.
+    :param queries: List of queries to compare on.
+    :param model: SciBERT model for the query embeddings.
+    :param tokenizer: Tokenizer for the SciBERT model.
+    :param codec_names: Codecs to compare.
+    :param top_k: Number of documents compared per query.
+    :param refine_factor: Number of candidates per result rescored on the float32 vectors.
+    :return: DataFrame with one row per codec.
+    """
+    comparison_dir = index_dir.rstrip(os.sep) + '.codec_comparison'
+    shutil.rmtree(comparison_dir, ignore_errors=True)  # left over by an interrupted comparison
+    with index_file_lock(index_dir):
+        shutil.copytree(index_dir, comparison_dir, ignore=shutil.ignore_patterns('.lock'))
+
+    try:
+        meta = load_index_meta(comparison_dir)
+
+        def window_file_bytes(file_name):
+            return sum(os.path.getsize(os.path.join(comparison_dir, shard_name, file_name)) for shard_name in meta['shards'])
+
+        def top_doc_ids(index, refine):
+            return [set(sharded_search(index, query, model, tokenizer, top_k=top_k, refine_factor=refine)['doc_id']) for query in queries]
+
+        remove_vector_codec(comparison_dir)
+        index = open_sharded_index(comparison_dir)
+        reference = top_doc_ids(index, None)
+        close_sharded_index(index)
+        float32_bytes = window_file_bytes('window_embeddings.bin')
+
+        report = []
+        for codec_name in codec_names:
+            compress_sharded_index(comparison_dir, codec_name)
+            index = open_sharded_index(comparison_dir)
+            agreements = {}
+            for label, refine in [('compressed_only', 0), ('refined', refine_factor)]:
+                results = top_doc_ids(index, refine)
+                agreements[label] = np.mean([len(result & expected) / top_k for result, expected in zip(results, reference)])
+            close_sharded_index(index)
+
+            compressed_bytes = window_file_bytes('window_codes.bin')
+            report.append({
+                'codec': codec_name,
+                'window_vector_mb': compressed_bytes / 2**20,
+                'memory_saved': 1 - compressed_bytes / float32_bytes,
+                f'top{top_k}_agreement_compressed_only': agreements['compressed_only'],
+                f'top{top_k}_agreement_refined': agreements['refined'],
+            })
+        report.insert(0, {'codec': 'float32', 'window_vector_mb': float32_bytes / 2**20, 'memory_saved': 0.0,
+                          f'top{top_k}_agreement_compressed_only': 1.0, f'top{top_k}_agreement_refined': 1.0})
+    finally:
+        shutil.rmtree(comparison_dir)
+
+    report = pd.DataFrame(report)
+    print(report.to_string(index=False))
+    return report
+
+"""```
+#Usage of the compressed vectors
+compress_sharded_index('paperpeek_index', codec_name='int8')
+sharded_index = open_sharded_index('paperpeek_index')
+sharded_results = sharded_search(sharded_index, "model", scibert_model, tokenizer, refine_factor=4)
+
+# Memory saved against top-5 agreement with float32 on the sampled n-gram queries
+compare_vector_codecs('paperpeek_index', random_one_gram_queries + random_two_gram_queries, scibert_model, tokenizer)
+```
+"""
+
+"""# Out-of-core first level index
+
+For corpora larger than memory the first level is built by streaming the document store in chunks.
+Documents are hashed into a fixed feature space while document frequencies are accumulated, the TF-IDF matrix is
+written to disk as memory-mappable CSR arrays, and the topic model is trained online from those arrays.
+
+These artifacts are build-time only: build_sharded_index copies the document topics into the shards and pickles the
+models with the index. sync_index projects new papers with those models and never updates tfidf_*.bin or
+doc_topics.bin, so the first level directory describes the store version recorded in its meta and is rebuilt
+along with the index.
+"""
+
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.pipeline import make_pipeline
+
+def open_csr_arrays(first_level_dir, mode='r'):
+    return {
+        'indptr': open_memmap_array(os.path.join(first_level_dir, 'tfidf_indptr.bin'), np.int64),
+        'indices': open_memmap_array(os.path.join(first_level_dir, 'tfidf_indices.bin'), np.int32),
+        'data': open_memmap_array(os.path.join(first_level_dir, 'tfidf_data.bin'), np.float32, mode=mode),
+    }
+
+def csr_chunk(csr_arrays, start, stop, n_features):
+    """Load rows start to stop of an on-disk CSR matrix."""
+    first, last = csr_arrays['indptr'][start], csr_arrays['indptr'][stop]
+    return sp.csr_matrix((csr_arrays['data'][first:last], csr_arrays['indices'][first:last], csr_arrays['indptr'][start:stop + 1] - first),
+                         shape=(stop - start, n_features))
+
+def build_out_of_core_first_level(document_store, first_level_dir, n_features=2**20, n_topics_document=10, chunk_size=1000, max_df=0.95, min_df=2):
+    """
+    Build the TF-IDF matrix, LDA model and document-topic matrix of a document store without loading the corpus.
+
+    :param document_store: Document store of the preprocessed documents.
+    :param first_level_dir: Directory where the on-disk artifacts are written.
+    :param n_features: Size of the hashed feature space.
+    :param n_topics_document: Number of LDA topics.
+    :param chunk_size: Number of documents processed at a time.
+    :param max_df: Features in more than this fraction of the documents are ignored, like TfidfVectorizer.
+    :param min_df: Features in fewer than this number of documents are ignored, like TfidfVectorizer.
+    :return: The opened first level (see open_out_of_core_first_level).
+    """
+    os.makedirs(first_level_dir, exist_ok=True)
+    hasher = HashingVectorizer(stop_words='english', n_features=n_features, alternate_sign=False, norm=None)
+    n_documents = len(document_store['offsets']) - 1
+
+    # Pass 1: hash the term counts to disk and accumulate the document frequencies
+    for file_name in ['tfidf_indices.bin', 'tfidf_data.bin']:
+        open(os.path.join(first_level_dir, file_name), 'wb').close()
+    np.zeros(1, dtype=np.int64).tofile(os.path.join(first_level_dir, 'tfidf_indptr.bin'))
+
+    document_frequencies = np.zeros(n_features, dtype=np.int64)
+    n_entries = 0
+    for start in range(0, n_documents, chunk_size):
+        texts = [get_document_text(document_store, doc_id) for doc_id in range(start, min(start + chunk_size, n_documents))]
+        counts = hasher.transform(texts)
+        counts.sort_indices()
+
+        document_frequencies += np.bincount(counts.indices, minlength=n_features)
+        append_array(os.path.join(first_level_dir, 'tfidf_indices.bin'), counts.indices.astype(np.int32))
+        append_array(os.path.join(first_level_dir, 'tfidf_data.bin'), counts.data.astype(np.float32))
+        append_array(os.path.join(first_level_dir, 'tfidf_indptr.bin'), counts.indptr[1:].astype(np.int64) + n_entries)
+        n_entries += counts.nnz
+
+    # Smoothed idf like TfidfVectorizer, features outside [min_df, max_df] get a zero weight
+    idf = np.log((1 + n_documents) / (1 + document_frequencies)) + 1
+    idf[(document_frequencies < min_df) | (document_frequencies > max_df * n_documents)] = 0
+
+    # Pass 2: apply the idf weights and l2 normalization in place, and train the topic model online
+    csr_arrays = open_csr_arrays(first_level_dir, mode='r+')
+    lda_model = LatentDirichletAllocation(n_components=n_topics_document, random_state=0, learning_method='online', total_samples=n_documents)
+    for start in range(0, n_documents, chunk_size):
+        stop = min(start + chunk_size, n_documents)
+        first, last = csr_arrays['indptr'][start], csr_arrays['indptr'][stop]
+        row_lengths = np.diff(csr_arrays['indptr'][start:stop + 1])
+
+        values = csr_arrays['data'][first:last] * idf[csr_arrays['indices'][first:last]]
+        row_norms = np.sqrt(np.bincount(np.repeat(np.arange(stop - start), row_lengths), weights=values ** 2, minlength=stop - start))
+        row_norms[row_norms == 0] = 1
+        csr_arrays['data'][first:last] = values / np.repeat(row_norms, row_lengths)
+
+        lda_model.partial_fit(csr_chunk(csr_arrays, start, stop, n_features))
+    csr_arrays['data'].flush()
+
+    # Pass 3: document-topic matrix
+    open(os.path.join(first_level_dir, 'doc_topics.bin'), 'wb').close()
+    for start in range(0, n_documents, chunk_size):
+        stop = min(start + chunk_size, n_documents)
+        append_array(os.path.join(first_level_dir, 'doc_topics.bin'), lda_model.transform(csr_chunk(csr_arrays, start, stop, n_features)).astype(np.float64))
+
+    # The query path hashes the query and applies the same idf weights
+    tfidf_transformer = TfidfTransformer()
+    tfidf_transformer.idf_ = idf
+    tfidf_transformer.n_features_in_ = n_features
+    vectorizer = make_pipeline(hasher, tfidf_transformer)
+
+    with open(os.path.join(first_level_dir, 'first_level.pkl'), 'wb') as file:
+        pickle.dump({'lda_model': lda_model, 'vectorizer': vectorizer}, file)
+    with open(os.path.join(first_level_dir, 'first_level_meta.json'), 'w') as file:
+        json.dump({'n_documents': n_documents, 'n_features': n_features, 'n_topics': n_topics_document,
+                   'store_version': document_store['version']}, file)
+
+    return open_out_of_core_first_level(first_level_dir)
+
+def open_out_of_core_first_level(first_level_dir):
+    """
+    Open the on-disk first level artifacts.
+
+    :param first_level_dir: Directory written by build_out_of_core_first_level.
+    :return: Dictionary with the LDA model, the query vectorizer, the memory-mapped CSR arrays and document-topic matrix (rows are doc ids).
+    """
+    with open(os.path.join(first_level_dir, 'first_level_meta.json')) as file:
+        meta = json.load(file)
+    with open(os.path.join(first_level_dir, 'first_level.pkl'), 'rb') as file:
+        first_level = pickle.load(file)
+
+    first_level['meta'] = meta
+    first_level['csr_arrays'] = open_csr_arrays(first_level_dir)
+    first_level['doc_topics'] = open_memmap_array(os.path.join(first_level_dir, 'doc_topics.bin'), np.float64, meta['n_topics'])
+    return first_level
+
+"""```
+#Usage of the out-of-core first level
+out_of_core_first_level = build_out_of_core_first_level(document_stores['processed_document'], 'paperpeek_first_level')
+build_sharded_index(new_df, 'paperpeek_index', n_shards=4, model=scibert_model, tokenizer=tokenizer, first_level=out_of_core_first_level)
+```
+"""
+
+"""# Load testing
+
+run_load_test replays a query log (or the generated n-gram query sets) against a search target, which is any
+function taking a query: the in-process two-level retrieval, the sharded index, or a client of a serving process.
+Closed loop keeps a fixed number of requests in flight, open loop sends requests at a fixed arrival rate
+(Poisson arrivals) or at the timestamps of the log, and measures latency from the planned arrival time.
+"""
+
+import itertools
+import resource
+import sys
+
+LATENCY_HISTOGRAM_BINS = np.logspace(-3, 2, 51)  # 1 ms to 100 s
+
+def load_query_log(path):
+    """
+    Read a query log, either one query per line or JSON lines with a 'query' and an optional 'timestamp' in seconds.
+
+    :param path: Path of the query log.
+    :return: List of dictionaries with 'query' and 'timestamp' (None when missing).
+    """
+    query_log = []
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                entry = json.loads(line)
+                query_log.append({'query': entry['query'], 'timestamp': entry.get('timestamp')})
+            else:
+                query_log.append({'query': line, 'timestamp': None})
+    return query_log
+
+def ngram_query_log(ngram_queries):
+    # The n-gram query sets as a query log without timestamps
+    return [{'query': query, 'timestamp': None} for queries in ngram_queries.values() for query in queries]
+
+def make_in_process_target(df, level1_func=top_n_papers_refined, level2_func=process_papers_with_scibert_top_5, **kwargs):
+    def search(query):
+        with record_stage('preprocess'):
+            processed_query = preprocess_text(query)
+        return run_two_level_search(processed_query, df, preprocess_text, level1_func, level2_func, **kwargs)
+    return search
+
+def make_sharded_target(index, model, tokenizer, **kwargs):
+    def search(query):
+        return sharded_search(index, query, model, tokenizer, **kwargs)
+    # The shard workers hold the index, their memory is sampled with the coordinator's (read at each sample, a refresh replaces them)
+    search.worker_pids = lambda: index['worker_pids']
+    return search
+
+def current_rss_mb(pid='self'):
+    try:
+        with open(f'/proc/{pid}/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        if pid != 'self':
+            # The worker has exited (or there is no /proc)
+            return 0.0
+        # Without /proc, fall back to the peak RSS (kilobytes on Linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def summarize_latencies(latencies):
+    latencies = np.asarray(latencies, dtype=np.float64)
+    if len(latencies) == 0:
+        return {}
+    histogram, _ = np.histogram(latencies, bins=LATENCY_HISTOGRAM_BINS)
+    return {
+        'count': int(len(latencies)),
+        'mean': float(latencies.mean()),
+        'p50': float(np.percentile(latencies, 50)),
+        'p90': float(np.percentile(latencies, 90)),
+        'p95': float(np.percentile(latencies, 95)),
+        'p99': float(np.percentile(latencies, 99)),
+        'max': float(latencies.max()),
+        'histogram': histogram.tolist(),
+    }
+
+def run_load_test(target, query_log, mode='closed', concurrency=4, arrival_rate=None, n_requests=None, duration_seconds=None,
+                  replay_timestamps=False, warmup_requests=1, memory_interval_seconds=1.0, label=None, seed=0):
+    """
+    Replay a query log against a search target and collect latencies, throughput, cache hit rates and memory.
+
+    :param target: Function running one query. If it has a worker_pids attribute (see make_sharded_target), the RSS of
+                   those processes is added to the memory samples (pages still shared since the fork are counted in each
+                   process, so the sum is an upper bound).
+    :param query_log: List of dictionaries with 'query' and 'timestamp' (see load_query_log).
+    :param mode: 'closed' (concurrency requests always in flight) or 'open' (requests arrive independently of completions).
+    :param concurrency: Number of concurrent requests in closed loop, or of worker threads in open loop.
+    :param arrival_rate: Requests per second in open loop, ignored when replay_timestamps is True.
+    :param n_requests: Number of requests to send. If None, the query log is replayed once (or until duration_seconds).
+    :param duration_seconds: (Optional) Stop sending requests after this time.
+    :param replay_timestamps: In open loop, send the requests at the relative timestamps of the query log.
+    :param warmup_requests: Requests run before the measurement, e.g. to build the first level index.
+    :param memory_interval_seconds: Interval between two RSS samples.
+    :param label: Name of the build or configuration, used when comparing reports.
+    :param seed: Seed of the Poisson arrivals.
+    :return: Dictionary with the report.
+    """
+    if mode not in ('closed', 'open'):
+        raise ValueError(f"Unknown load test mode: {mode}")
+    if not query_log:
+        raise ValueError("The query log is empty")
+    if mode == 'open' and replay_timestamps and any(entry['timestamp'] is None for entry in query_log):
+        raise ValueError("Replaying timestamps needs a timestamp on every query log entry")
+    if mode == 'open' and not replay_timestamps and not arrival_rate:
+        raise ValueError("Open loop needs an arrival_rate or replay_timestamps=True")
+
+    if n_requests is None and duration_seconds is None:
+        n_requests = len(query_log)
+    n_requests = n_requests if n_requests is not None else sys.maxsize
+    queries = itertools.cycle(query_log)
+
+    for entry in itertools.islice(itertools.cycle(query_log), warmup_requests):
+        target(entry['query'])
+
+    caches = {'query_result_cache': query_result_cache, 'query_embedding_cache': query_embedding_cache}
+    cache_counts_before = {name: cache_counts(cache) for name, cache in caches.items()}
+
+    records = []
+    records_lock = threading.Lock()
+
+    def run_request(query, planned_time):
+        stage_recorder.timings = {}
+        started_time = time.perf_counter()
+        error = None
+        try:
+            target(query)
+        except Exception as exception:
+            error = repr(exception)
+        finished_time = time.perf_counter()
+
+        stages = stage_recorder.timings
+        stage_recorder.timings = None
+        # In open loop the time spent waiting for a free worker is part of the latency
+        stages['queue'] = started_time - planned_time
+        with records_lock:
+            records.append({'query': query, 'start': planned_time - test_start, 'latency': finished_time - planned_time,
+                            'stages': stages, 'error': error})
+
+    # Memory over time, sampled on a background thread, including the worker processes of the target
+    worker_pids = getattr(target, 'worker_pids', lambda: [])
+    memory_samples = []
+    sampling_done = threading.Event()
+
+    def sample_memory():
+        while not sampling_done.is_set():
+            rss = current_rss_mb() + sum(current_rss_mb(pid) for pid in worker_pids())
+            memory_samples.append((time.perf_counter() - test_start, rss))
+            sampling_done.wait(memory_interval_seconds)
+
+    test_start = time.perf_counter()
+    deadline = test_start + duration_seconds if duration_seconds is not None else None
+    memory_thread = threading.Thread(target=sample_memory, daemon=True)
+    memory_thread.start()
+
+    if mode == 'closed':
+        sent = itertools.count()
+        queries_lock = threading.Lock()
+
+        def closed_loop_worker():
+            while True:
+                with queries_lock:
+                    if next(sent) >= n_requests or (deadline is not None and time.perf_counter() >= deadline):
+                        return
+                    entry = next(queries)
+                run_request(entry['query'], time.perf_counter())
+
+        workers = [threading.Thread(target=closed_loop_worker) for _ in range(concurrency)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    elif mode == 'open':
+        rng = np.random.default_rng(seed)
+        first_timestamp = query_log[0]['timestamp']
+        next_arrival = test_start
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for request_number in range(n_requests):
+                entry = next(queries)
+                if replay_timestamps:
+                    # Timestamps are relative to the first entry, a replayed log wraps around after its last entry
+                    if request_number and request_number % len(query_log) == 0:
+                        first_timestamp = entry['timestamp'] - (next_arrival - test_start)
+                    next_arrival = test_start + (entry['timestamp'] - first_timestamp)
+                else:
+                    next_arrival += rng.exponential(1 / arrival_rate)
+                if deadline is not None and next_arrival >= deadline:
+                    break
+
+                time.sleep(max(0.0, next_arrival - time.perf_counter()))
+                pool.submit(run_request, entry['query'], next_arrival)
+
+    test_seconds = time.perf_counter() - test_start
+    sampling_done.set()
+    memory_thread.join()
+
+    stage_names = sorted({stage for record in records for stage in record['stages']})
+    successful = [record for record in records if record['error'] is None]
+    cache_hit_rates = {}
+    for name, cache in caches.items():
+        hits, misses = cache_counts(cache)
+        hits -= cache_counts_before[name][0]
+        misses -= cache_counts_before[name][1]
+        cache_hit_rates[name] = hits / (hits + misses) if hits + misses else None
+
+    return {
+        'label': label,
+        'config': {'mode': mode, 'concurrency': concurrency, 'arrival_rate': arrival_rate, 'n_requests': len(records),
+                   'duration_seconds': duration_seconds, 'replay_timestamps': replay_timestamps},
+        'histogram_bins': LATENCY_HISTOGRAM_BINS.tolist(),
+        'test_seconds': test_seconds,
+        'throughput': len(successful) / test_seconds if test_seconds else 0.0,
+        'errors': len(records) - len(successful),
+        'latency': summarize_latencies([record['latency'] for record in successful]),
+        'stage_latency': {stage: summarize_latencies([record['stages'][stage] for record in successful if stage in record['stages']])
+                          for stage in stage_names},
+        'cache_hit_rates': cache_hit_rates,
+        'memory_mb': memory_samples,
+        'peak_memory_mb': max((rss for _, rss in memory_samples), default=None),
+    }
+
+def write_load_test_report(report, path):
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=2)
+
+def compare_load_test_reports(paths):
+    """
+    Put the main figures of several load test reports side by side.
+
+    :param paths: Paths of reports written by write_load_test_report.
+    :return: DataFrame with one row per report.
+    """
+    rows = []
+    for path in paths:
+        with open(path) as file:
+            report = json.load(file)
+        row = {
+            'label': report['label'] or os.path.basename(path),
+            'mode': report['config']['mode'],
+            'concurrency': report['config']['concurrency'],
+            'throughput': report['throughput'],
+            'errors': report['errors'],
+            'p50': report['latency'].get('p50'),
+            'p95': report['latency'].get('p95'),
+            'p99': report['latency'].get('p99'),
+            'peak_memory_mb': report['peak_memory_mb'],
+        }
+        for stage, summary in report['stage_latency'].items():
+            row[f'{stage}_p95'] = summary.get('p95')
+        for name, hit_rate in report['cache_hit_rates'].items():
+            row[f'{name}_hit_rate'] = hit_rate
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+"""```
+#Usage of the load test
+load_test_report = run_load_test(make_in_process_target(new_df), ngram_query_log(ngram_queries), mode='closed', concurrency=4, label='in-process')
+write_load_test_report(load_test_report, 'load_test_in_process.json')
+
+sharded_index = open_sharded_index('paperpeek_index')
+load_test_report = run_load_test(make_sharded_target(sharded_index, scibert_model, tokenizer), load_query_log('queries.jsonl'),
+                                 mode='open', concurrency=16, arrival_rate=5, duration_seconds=300, label='sharded')
+write_load_test_report(load_test_report, 'load_test_sharded.json')
+
+compare_load_test_reports(['load_test_in_process.json', 'load_test_sharded.json'])
+```
+"""
+
+"""# Versioned index snapshots
+
+A snapshot is an immutable copy of a sharded index, its document stores and the embedding cache, written to
+snapshots/<version>/ with a manifest holding the sha256 checksum of every file. A snapshot directory is only
+renamed into place once it is complete, and the CURRENT file naming the served version is replaced atomically.
+A snapshot server loads a new snapshot in the background and switches to it between queries, keeping the
+previous snapshot open for rollback.
+"""
+
+SNAPSHOT_MANIFEST = 'manifest.json'
+
+def file_sha256(path, block_size=2**20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def snapshot_files(snapshot_dir):
+    # Relative paths of all the files of a snapshot except the manifest
+    paths = []
+    for root, dirs, files in os.walk(snapshot_dir):
+        dirs.sort()
+        for file in sorted(files):
+            path = os.path.relpath(os.path.join(root, file), snapshot_dir)
+            if path != SNAPSHOT_MANIFEST:
+                paths.append(path)
+    return paths
+
+def read_current_snapshot(snapshot_root):
+    try:
+        with open(os.path.join(snapshot_root, 'CURRENT')) as file:
+            return file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def set_current_snapshot(snapshot_root, version):
+    with open(os.path.join(snapshot_root, 'CURRENT.tmp'), 'w') as file:
+        file.write(version)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(os.path.join(snapshot_root, 'CURRENT.tmp'), os.path.join(snapshot_root, 'CURRENT'))
+
+def publish_snapshot(index_dir, snapshot_root, cache_files=('embeddings_cache_v3.pkl',), make_current=True):
+    """
+    Copy a sharded index, its document stores and the embedding cache into a new snapshot.
+
+    :param index_dir: Directory of the sharded index.
+    :param snapshot_root: Directory holding the snapshots.
+    :param cache_files: Cache files copied into the snapshot (missing files are skipped).
+    :param make_current: If True, the new snapshot becomes the served version.
+    :return: The version of the snapshot.
+    """
+    snapshots_dir = os.path.join(snapshot_root, 'snapshots')
+    os.makedirs(snapshots_dir, exist_ok=True)
+    version = time.strftime('%Y%m%d-%H%M%S') + '-' + hashlib.sha1(os.urandom(16)).hexdigest()[:8]
+    snapshot_dir = os.path.join(snapshots_dir, version)
+    staging_dir = os.path.join(snapshots_dir, '.' + version + '.tmp')
+
+    # No sync or compaction, in this process or another, may change the index while it is copied
+    # The document stores live inside the index directory, so they are copied with it
+    with index_file_lock(index_dir):
+        shutil.copytree(index_dir, os.path.join(staging_dir, 'index'), ignore=shutil.ignore_patterns('.lock'))
+
+    for cache_file in cache_files:
+        if os.path.exists(cache_file):
+            os.makedirs(os.path.join(staging_dir, 'caches'), exist_ok=True)
+            shutil.copy2(cache_file, os.path.join(staging_dir, 'caches', os.path.basename(cache_file)))
+
+    manifest = {
+        'version': version,
+        'created_at': time.time(),
+        'parent': read_current_snapshot(snapshot_root),
+        'source_index_dir': os.path.abspath(index_dir),
+        'files': {path: {'size': os.path.getsize(os.path.join(staging_dir, path)), 'sha256': file_sha256(os.path.join(staging_dir, path))}
+                  for path in snapshot_files(staging_dir)},
+    }
+    with open(os.path.join(staging_dir, SNAPSHOT_MANIFEST), 'w') as file:
+        json.dump(manifest, file, indent=2)
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.rename(staging_dir, snapshot_dir)
+    if make_current:
+        set_current_snapshot(snapshot_root, version)
+    return version
+
+def verify_snapshot(snapshot_dir, check_checksums=True):
+    """
+    Check that a snapshot holds exactly the files of its manifest, with the recorded sizes and checksums.
+
+    :param snapshot_dir: Directory of the snapshot.
+    :param check_checksums: If False, only the file list and sizes are checked.
+    :return: The manifest of the snapshot.
+    """
+    with open(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST)) as file:
+        manifest = json.load(file)
+
+    if sorted(manifest['files']) != snapshot_files(snapshot_dir):
+        raise ValueError(f"Snapshot {manifest['version']} does not match its manifest")
+    for path, expected in manifest['files'].items():
+        full_path = os.path.join(snapshot_dir, path)
+        if os.path.getsize(full_path) != expected['size'] or (check_checksums and file_sha256(full_path) != expected['sha256']):
+            raise ValueError(f"Snapshot {manifest['version']} is corrupted: {path}")
+    return manifest
+
+def list_snapshots(snapshot_root):
+    # Complete snapshots, oldest first (versions start with their creation time)
+    snapshots_dir = os.path.join(snapshot_root, 'snapshots')
+    if not os.path.isdir(snapshots_dir):
+        return []
+    return sorted(name for name in os.listdir(snapshots_dir)
+                  if not name.startswith('.') and os.path.exists(os.path.join(snapshots_dir, name, SNAPSHOT_MANIFEST)))
+
+def open_snapshot(snapshot_root, version, check_checksums=True):
+    """Verify a snapshot and open its sharded index and document stores."""
+    snapshot_dir = os.path.join(snapshot_root, 'snapshots', version)
+    verify_snapshot(snapshot_dir, check_checksums)
+
+    index = open_sharded_index(os.path.join(snapshot_dir, 'index'))
+    index['version'] = version
+    index['document_stores'] = open_snapshot_document_stores(snapshot_root, version)
+    index['active_queries'] = 0
+    return index
+
+def open_snapshot_document_stores(snapshot_root, version):
+    snapshot_index_dir = os.path.join(snapshot_root, 'snapshots', version, 'index')
+    store_path = index_store_dir(snapshot_index_dir, load_index_meta(snapshot_index_dir))
+    return {text_col: open_document_store(os.path.join(store_path, text_col)) for text_col in ['processed_document', 'processed_summary']}
+
+def snapshot_document_stores(server, version):
+    """
+    Return the document stores of a snapshot, to display results with the text they were computed on.
+    The global document_stores are never replaced by a snapshot, they belong to the working index.
+    """
+    for index in [server['current'], server['previous']]:
+        if index is not None and index['version'] == version:
+            return index['document_stores']
+    return open_snapshot_document_stores(server['snapshot_root'], version)
+
+def open_snapshot_server(snapshot_root, check_checksums=True):
+    """
+    Serve the CURRENT snapshot.
+
+    :param snapshot_root: Directory holding the snapshots.
+    :param check_checksums: If False, snapshots are only checked against the file list and sizes of their manifest.
+    :return: Dictionary with the served and previous index.
+    """
+    version = read_current_snapshot(snapshot_root)
+    if version is None:
+        raise FileNotFoundError(f"No current snapshot in {snapshot_root}")
+
+    server = {
+        'snapshot_root': snapshot_root,
+        'check_checksums': check_checksums,
+        'condition': threading.Condition(),
+        'current': None,
+        'previous': None,
+        'loading_thread': None,
+    }
+    swap_snapshot(server, open_snapshot(snapshot_root, version, check_checksums))
+    return server
+
+def swap_snapshot(server, index):
+    # The swap only replaces references, queries already running finish on the index they started with
+    with server['condition']:
+        retired_index = server['previous']
+        server['previous'] = server['current']
+        server['current'] = index
+    if retired_index is not None:
+        threading.Thread(target=retire_snapshot, args=(server, retired_index), daemon=True).start()
+
+def retire_snapshot(server, index):
+    with server['condition']:
+        server['condition'].wait_for(lambda: index['active_queries'] == 0)
+    close_sharded_index(index)
+
+def load_snapshot_in_background(server, version=None, make_current=True):
+    """
+    Open a snapshot on a background thread and switch to it once it is loaded.
+    Queries keep running during the load, only the forks of the shard workers wait for a moment without queries in flight.
+
+    :param server: Server returned by open_snapshot_server.
+    :param version: Version to load. If None, the CURRENT snapshot is loaded.
+    :param make_current: If True, CURRENT is updated once the snapshot serves queries.
+    :return: The loading thread.
+    """
+    def load():
+        snapshot_version = version or read_current_snapshot(server['snapshot_root'])
+        if server['current'] is not None and server['current']['version'] == snapshot_version:
+            return
+        try:
+            index = open_snapshot(server['snapshot_root'], snapshot_version, server['check_checksums'])
+        except (OSError, ValueError, RuntimeError) as error:
+            # The served snapshot stays in place
+            print(f"Could not load snapshot {snapshot_version}: {error}")
+            return
+        swap_snapshot(server, index)
+        if make_current:
+            set_current_snapshot(server['snapshot_root'], snapshot_version)
+        print("Serving snapshot:", snapshot_version)
+
+    loading_thread = threading.Thread(target=load, daemon=True)
+    loading_thread.start()
+    server['loading_thread'] = loading_thread
+    return loading_thread
+
+def rollback_snapshot(server):
+    """Switch back to the previously served snapshot, which is still open, and make it CURRENT again."""
+    with server['condition']:
+        if server['previous'] is None:
+            raise ValueError("No previous snapshot to roll back to")
+        server['current'], server['previous'] = server['previous'], server['current']
+        version = server['current']['version']
+    set_current_snapshot(server['snapshot_root'], version)
+    return version
+
+def snapshot_search(server, query, model, tokenizer, **kwargs):
+    """
+    Run sharded_search on the served snapshot.
+
+    :param server: Server returned by open_snapshot_server.
+    :param query: The user query.
+    :param model: SciBERT model for the query embedding.
+    :param tokenizer: Tokenizer for the SciBERT model.
+    :return: DataFrame of the top papers, with the served version in the 'snapshot_version' column.
+    """
+    with server['condition']:
+        index = server['current']
+        index['active_queries'] += 1
+    try:
+        results = sharded_search(index, query, model, tokenizer, **kwargs)
+        results['snapshot_version'] = index['version']
+        return results
+    finally:
+        with server['condition']:
+            index['active_queries'] -= 1
+            server['condition'].notify_all()
+
+def close_snapshot_server(server):
+    for index in [server['current'], server['previous']]:
+        if index is not None:
+            close_sharded_index(index)
+
+def gc_snapshots(snapshot_root, keep_last=3, max_age_days=None, protected_versions=()):
+    """
+    Delete old snapshots and unfinished snapshot directories.
+
+    :param snapshot_root: Directory holding the snapshots.
+    :param keep_last: Number of most recent snapshots always kept.
+    :param max_age_days: (Optional) Older snapshots beyond keep_last are deleted only after this age. If None, they are deleted right away.
+    :param protected_versions: Versions never deleted, e.g. the current and previous snapshots of a server.
+    :return: List of the deleted versions.
+    """
+    snapshots_dir = os.path.join(snapshot_root, 'snapshots')
+    protected = set(protected_versions) | {read_current_snapshot(snapshot_root)}
+    versions = list_snapshots(snapshot_root)
+
+    deleted = []
+    for version in versions[:max(len(versions) - keep_last, 0)]:
+        if version in protected:
+            continue
+        if max_age_days is not None:
+            with open(os.path.join(snapshots_dir, version, SNAPSHOT_MANIFEST)) as file:
+                created_at = json.load(file)['created_at']
+            if time.time() - created_at < max_age_days * 24 * 3600:
+                continue
+        shutil.rmtree(os.path.join(snapshots_dir, version))
+        deleted.append(version)
+
+    # Staging directories left by interrupted publications
+    for name in os.listdir(snapshots_dir):
+        if name.startswith('.') and name.endswith('.tmp'):
+            shutil.rmtree(os.path.join(snapshots_dir, name))
+
+    return deleted
+
+"""```
+#Usage of the index snapshots
+# Build or sync the working index, then publish it as a snapshot
+sync_index(dataset_path, 'paperpeek_index', scibert_model, tokenizer)
+publish_snapshot('paperpeek_index', 'paperpeek_snapshots')
+
+# Serving process
+snapshot_server = open_snapshot_server('paperpeek_snapshots')
+snapshot_results = snapshot_search(snapshot_server, "model", scibert_model, tokenizer)
+display_similar_segments(snapshot_results, 'paper_name', stores=snapshot_document_stores(snapshot_server, snapshot_results['snapshot_version'].iloc[0]))
+
+# After a new publication, switch to it without interrupting queries, or go back to the previous snapshot
+load_snapshot_in_background(snapshot_server)
+rollback_snapshot(snapshot_server)
+
+served_versions = [index['version'] for index in (snapshot_server['current'], snapshot_server['previous']) if index is not None]
+gc_snapshots('paperpeek_snapshots', keep_last=3, protected_versions=served_versions)
+```
+"""
 
 
 """def retrieve_documents_for_all_ngrams(df, one_grams_col, two_grams_col, three_grams_col, preprocess_text, top_n_papers_refined, process_papers_with_scibert_top_5):
@@ -579,58 +3110,85 @@ def two_level_retrieval_system_for_eval(query,df, preprocess_text, level1_func,
 
     return final_results
 
-def extract_and_separate_key_phrases(df, summary_column, n_phrases=3):
-    vectorizer = TfidfVectorizer(ngram_range=(1, 3), stop_words='english')
-
-    X = vectorizer.fit_transform(df[summary_column])
-    feature_array = np.array(vectorizer.get_feature_names_out())
-
-    one_grams, two_grams, three_grams = [], [], []
-
-    for i in range(X.shape[0]):
-        tfidf_sorting = np.argsort(X[i].toarray()).flatten()[::-1]
-        top_n = feature_array[tfidf_sorting][:n_phrases]
-
-        one_gram = [phrase for phrase in top_n if len(phrase.split()) == 1]
-        two_gram = [phrase for phrase in top_n if len(phrase.split()) == 2]
-        three_gram = [phrase for phrase in top_n if len(phrase.split()) == 3]
-
-        one_grams.append(one_gram)
-        two_grams.append(two_gram)
-        three_grams.append(three_gram)
-
-    df['one_grams'] = one_grams
-    df['two_grams'] = two_grams
-    df['three_grams'] = three_grams
-
-    return df
-
 # User query simulation
 """
 
-def extract_and_separate_key_phrases(df, summary_column, n_phrases=3):
-    vectorizer = TfidfVectorizer(ngram_range=(1, 3), stop_words='english')
+from joblib import Parallel, delayed
+from sklearn.utils import murmurhash3_32
 
-    X = vectorizer.fit_transform(df[summary_column])
-    feature_array = np.array(vectorizer.get_feature_names_out())
-
-    one_grams, two_grams, three_grams = [], [], []
-
-    for i in range(X.shape[0]):
-        tfidf_sorting = np.argsort(X[i].toarray()).flatten()[::-1]
-        top_n = feature_array[tfidf_sorting][:n_phrases]
+def select_top_features(X_chunk, n_phrases):
+    """
+    Return the feature ids of the n_phrases highest scoring entries of each row, best first.
+    Only the non-zero entries of the CSR rows are looked at.
+    """
+    top_feature_ids = []
+    for row in range(X_chunk.shape[0]):
+        start, end = X_chunk.indptr[row], X_chunk.indptr[row + 1]
+        row_scores = X_chunk.data[start:end]
+
+        # Partial selection of the n_phrases best entries, then sort only those
+        if end - start > n_phrases:
+            best = np.argpartition(-row_scores, n_phrases - 1)[:n_phrases]
+        else:
+            best = np.arange(end - start)
+        best = best[np.argsort(-row_scores[best], kind='stable')]
+
+        top_feature_ids.append(X_chunk.indices[start:end][best])
+    return top_feature_ids
+
+def hashed_feature_id(phrase, n_features):
+    # Same bucket as HashingVectorizer (signed 32 bit murmurhash with seed 0)
+    h = murmurhash3_32(phrase, seed=0)
+    if h == -2147483648:
+        return (2147483647 - (n_features - 1)) % n_features
+    return abs(h) % n_features
+
+def resolve_hashed_phrases(text, feature_ids, analyzer, n_features):
+    """Map hashed feature ids back to the first n-gram of the text that falls into each bucket."""
+    phrases = {}
+    wanted = set(feature_ids.tolist())
+    for phrase in analyzer(text):
+        feature_id = hashed_feature_id(phrase, n_features)
+        if feature_id in wanted and feature_id not in phrases:
+            phrases[feature_id] = phrase
+    return [phrases[feature_id] for feature_id in feature_ids.tolist() if feature_id in phrases]
+
+def extract_and_separate_key_phrases(df, summary_column, n_phrases=3, max_features=None, n_features=None, chunk_size=1000, n_jobs=1):
+    """
+    Extract the top n_phrases TF-IDF key phrases (1 to 3 grams) of every summary and separate them by length.
+
+    :param df: DataFrame containing the summaries.
+    :param summary_column: Name of the summary column.
+    :param n_phrases: Number of key phrases per summary.
+    :param max_features: (Optional) Keep only the max_features most frequent n-grams in the vocabulary.
+    :param n_features: (Optional) Hash the n-grams into n_features buckets instead of building a vocabulary.
+    :param chunk_size: Number of rows selected per chunk.
+    :param n_jobs: Number of chunks processed in parallel.
+    :return: The DataFrame with 'one_grams', 'two_grams' and 'three_grams' columns.
+    """
+    if n_features is None:
+        vectorizer = TfidfVectorizer(ngram_range=(1, 3), stop_words='english', max_features=max_features)
+        X = vectorizer.fit_transform(load_column_texts(df, summary_column))
+        feature_array = vectorizer.get_feature_names_out()
+    else:
+        vectorizer = HashingVectorizer(ngram_range=(1, 3), stop_words='english', n_features=n_features, alternate_sign=False, norm=None)
+        X = TfidfTransformer().fit_transform(vectorizer.transform(load_column_texts(df, summary_column)))
+    X = X.tocsr()
 
-        one_gram = [phrase for phrase in top_n if len(phrase.split()) == 1]
-        two_gram = [phrase for phrase in top_n if len(phrase.split()) == 2]
-        three_gram = [phrase for phrase in top_n if len(phrase.split()) == 3]
+    chunks = [X[start:start + chunk_size] for start in range(0, X.shape[0], chunk_size)]
+    chunk_results = Parallel(n_jobs=n_jobs)(delayed(select_top_features)(chunk, n_phrases) for chunk in chunks)
+    top_feature_ids = [feature_ids for chunk_result in chunk_results for feature_ids in chunk_result]
 
-        one_grams.append(one_gram)
-        two_grams.append(two_gram)
-        three_grams.append(three_gram)
+    if n_features is None:
+        top_phrases = [feature_array[feature_ids].tolist() for feature_ids in top_feature_ids]
+    else:
+        analyzer = vectorizer.build_analyzer()
+        top_phrases = [resolve_hashed_phrases(text, feature_ids, analyzer, n_features)
+                       for text, feature_ids in zip(load_column_texts(df, summary_column), top_feature_ids)]
 
-    df['one_grams'] = one_grams
-    df['two_grams'] = two_grams
-    df['three_grams'] = three_grams
+    df['one_grams'] = [[phrase for phrase in phrases if len(phrase.split()) == 1] for phrases in top_phrases]
+    df['two_grams'] = [[phrase for phrase in phrases if len(phrase.split()) == 2] for phrases in top_phrases]
+    df['three_grams'] = [[phrase for phrase in phrases if len(phrase.split()) == 3] for phrases in top_phrases]
 
     return df
 
@@ -683,47 +3241,35 @@ def two_level_retrieval_system_for_ngrams(ngram_queries, df, preprocess_text, le
     # Initialize a list to collect results
     results = []
 
-    # Other initializations as before
-    lda_document_model, tfidf_vectorizer_document = apply_tfidf_and_lda(df,'processed_document')
-
     for ngram_type, queries in ngram_queries.items():
         for query in queries:
             processed_query = preprocess_text(query)
 
-            # Level 1 Retrieval as before
-            level1_results = level1_func(
-                query=processed_query,
-                lda_model=lda_document_model,
-                dtm=tfidf_vectorizer_document.transform(df['processed_document']),
-                dataframe=df,
-                vectorizer=tfidf_vectorizer_document,
-                citation_col='citation_count',
-                normalized_col='normalized_score',
-                preprocess_function=preprocess_text,
+            # Level 1 and Level 2 Retrieval, repeated queries are served from the result cache
+            final_results = run_two_level_search(
+                processed_query, df, preprocess_text, level1_func, level2_func,
+                *args,
                 n=25,
                 similarity_weight=0.7,
                 citation_weight=0.2,
                 normalized_weight=0.1,
-                *args, **kwargs
+                **kwargs
             )
 
-            # Level 2 Retrieval as before
-            final_results = level2_func(level1_results, 'processed_document', processed_query, scibert_model, tokenizer)
-
             # Collect the results
             for index in final_results.index:
-                document_row = df.loc[index]  # Get the corresponding document row from the original DataFrame
+                document_row = final_results.loc[index]  # Scores come from this query's results, not from the shared DataFrame
                 result_row = {
                     'ngram_type': ngram_type,
                     'query': query,
                     'index': index,
-                    'processed_document': document_row.get('processed_document', None),  # Handle missing column
-                    'processed_summary': document_row.get('processed_summary', None),  # Handle missing column
+                    'doc_id': document_row.get('doc_id', None),  # Text is loaded from the document store on demand
                     'normalized_score': document_row.get('normalized_score', None),  # Handle missing column
                     'citation_count': document_row.get('citation_count', None),  # Handle missing column
                     'paper_name': document_row.get('paper_name', None),  # Handle missing column
                     'combined_score': document_row.get('combined_score', None),  # Handle missing column
-                    'most_similar_segment': document_row.get('most_similar_segment', None),  # Handle missing column
+                    'segment_start': document_row.get('segment_start', None),  # Handle missing column
+                    'segment_end': document_row.get('segment_end', None),  # Handle missing column
                     'similarity_score': document_row.get('similarity_score', None),  # Handle missing column
                 }
 
@@ -734,6 +3280,78 @@ def two_level_retrieval_system_for_ngrams(ngram_queries, df, preprocess_text, le
 
     return result_df
 
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def measure_rss_increase(func, *args, interval_seconds=0.05):
+    """
+    Run func in a forked process and return the peak increase of its RSS in MB.
+    The fork starts from the memory of this process, so only what func allocates is counted.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # The child must never return into the caller's frames, whatever func does
+        exit_code = 1
+        try:
+            os.close(read_fd)
+            start_rss = current_rss_mb()
+            peak_rss = [start_rss]
+            done = threading.Event()
+
+            def sample():
+                while not done.is_set():
+                    peak_rss[0] = max(peak_rss[0], current_rss_mb())
+                    done.wait(interval_seconds)
+
+            sampler = threading.Thread(target=sample, daemon=True)
+            sampler.start()
+            try:
+                func(*args)
+            finally:
+                done.set()
+                sampler.join()
+            peak_rss[0] = max(peak_rss[0], current_rss_mb())
+            os.write(write_fd, f"ok {peak_rss[0] - start_rss}".encode())
+            exit_code = 0
+        except BaseException as error:
+            os.write(write_fd, f"error {error!r}".encode())
+        finally:
+            os._exit(exit_code)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        output = pipe.read()
+    _, status = os.waitpid(pid, 0)
+    exit_code = os.waitstatus_to_exitcode(status)
+
+    if not output.startswith('ok ') or exit_code != 0:
+        raise RuntimeError(f"Memory measurement failed (exit code {exit_code}): {output[len('error '):] if output.startswith('error ') else output}")
+    return float(output[len('ok '):])
+
+def compare_text_layout_memory(dataframe, workload, text_cols=('processed_document', 'processed_summary')):
+    """
+    Compare the memory of a workload when the processed texts are DataFrame columns (the layout before the
+    document store) and when they are read from the document store.
+
+    :param dataframe: DataFrame with a 'doc_id' column and no text columns.
+    :param workload: Function taking the DataFrame, e.g. fitting the first level and running queries.
+    :param text_cols: Text columns held in memory by the baseline.
+    :return: Dictionary with the RSS increase in MB of both layouts.
+    """
+    def in_memory_columns():
+        # load_column_texts and load_row_text read a column present in the DataFrame instead of the store
+        baseline_dataframe = dataframe.copy()
+        for text_col in text_cols:
+            baseline_dataframe[text_col] = list(load_column_texts(dataframe, text_col))
+        workload(baseline_dataframe)
+
+    return {
+        'in_memory_columns_mb': measure_rss_increase(in_memory_columns),
+        'document_store_mb': measure_rss_increase(workload, dataframe),
+    }
+
 embeddings_cache = load_cache_from_file('embeddings_cache_v3.pkl')
 
 # using 100 random 1 grams and 2 grams queries to evaluate
@@ -745,6 +3363,8 @@ ngram_queries = {
     '2gram': random_two_gram_queries,
 }
 
+print(f"Peak RSS before n-gram evaluation: {peak_rss_mb():.1f} MB")
+
 retrieval_results = two_level_retrieval_system_for_ngrams(
     ngram_queries,
     df=new_df,
@@ -755,6 +3375,25 @@ retrieval_results = two_level_retrieval_system_for_ngrams(
 )
 save_cache_to_file(embeddings_cache, 'embeddings_cache_v3.pkl')
 
+print(f"Peak RSS after n-gram evaluation: {peak_rss_mb():.1f} MB")
+
+"""
+Peak RSS only shows the high-water mark of the whole notebook, compare_text_layout_memory measures the
+same workload with the texts in DataFrame columns and in the document store.
+On a synthetic corpus of 3000 processed documents of 6000 words (117 MB of text), the workload below peaked
+at +339 MB with the text columns and +215 MB with the document store (-37%). The raw 'document' and 'summary'
+columns, also dropped from the DataFrame, are not part of this baseline.
+```
+def first_level_workload(dataframe):
+    lda_model, vectorizer = apply_tfidf_and_lda(dataframe, 'processed_document')
+    dtm = vectorizer.transform(load_column_texts(dataframe, 'processed_document'))
+    for query in random_one_gram_queries[:10]:
+        top_n_papers_refined(query, lda_model, dtm, dataframe, vectorizer, 'citation_count', 'normalized_score', preprocess_text)
+
+print(compare_text_layout_memory(new_df, first_level_workload))
+```
+"""
+
 """
 for using all ngram queries
 ```
@@ -834,7 +3473,7 @@ def find_relevant_docs_for_all_ngrams(ngram_queries, all_summaries, all_document
 
     return all_relevant_docs
 
-all_summaries = new_df['processed_summary'].tolist()  # List of document summaries
+all_summaries = list(load_column_texts(new_df, 'processed_summary'))  # List of document summaries
 all_documents = new_df # DataFrame containing all documents
 
 comprehensive_relevant_docs_df = find_relevant_docs_for_all_ngrams(